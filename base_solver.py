@@ -4,6 +4,7 @@
 from datetime import datetime, timedelta
 
 from helpers import TimeoutError, INF
+from local_search import LocalSearch
 
 
 class RunSolverFirst(Exception):
@@ -20,6 +21,12 @@ class BaseSolver(object):
 
     a_solver = True  # just to find solvrs easier
 
+    # Optional post processing of the best solution with local search
+    # moves (like ('2opt', 'oropt')) - None turns it off.
+    local_search = None
+    local_search_gain = 0
+    local_search_time = None
+
     # timeout related
     timedout = False
 
@@ -38,8 +45,34 @@ class BaseSolver(object):
         finish_time = datetime.now()
         self.search_time = finish_time - self.start_time
 
+        if self.local_search and self.best_solution:
+            self.improve_solution()
+
         self.task.verify_route(self.best_solution, self)
 
+    def improve_solution(self):
+        start_time = datetime.now()
+
+        task = self.task
+        route = task.to_indices(self.best_solution)
+        search = None
+        try:
+            search = LocalSearch(task, moves=self.local_search,
+                                 check_timeout=self.check_deadline)
+            route = search.improve(route)
+        except TimeoutError:
+            # the route may be partly improved (it is still valid)
+            if search and search.route:
+                route = search.route
+        distance = task.path_cost(route)
+
+        if distance < self.best_distance:
+            self.local_search_gain = self.best_distance - distance
+            self.best_solution = task.to_names(route)
+            self.best_distance = distance
+
+        self.local_search_time = datetime.now() - start_time
+
     def run_search(self):
         # dummy - this is where one should implement the algorithm
         # this should include calls to self.check_timeout
@@ -54,6 +87,13 @@ class BaseSolver(object):
             self.time_to_get_out = self.start_time + timedelta(
                     seconds=self.task.timeout)
 
+    def check_deadline(self):
+        # like check_timeout, but the solver isn't marked as timed out -
+        # for post processing of a solution that was found in time
+        if self.task.timeout and datetime.now() > (
+                self.start_time + timedelta(seconds=self.task.timeout)):
+            raise TimeoutError
+
     def handle_timeout(self):
         # this can vary a lot between diffrent algorithms
         # (it may be usefull to get best solution found till now)
@@ -87,7 +127,13 @@ class BaseSolver(object):
                 'distance: {distance}\n'
             )
 
+        if self.local_search_time is not None:
+            txt += ('local search gain: {local_search_gain} '
+                    'in {local_search_time}\n')
+
         return txt.format(
+            local_search_gain=self.local_search_gain,
+            local_search_time=self.local_search_time,
             solver_name=str(self.__class__),
             cycles=self.cycles,
             search_time=self.search_time,
@@ -1,8 +1,13 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
-from itertools import permutations
-from math import sqrt, pow
+from array import array
+from heapq import heapify, heappop, heappush, nsmallest
+from itertools import izip
+from math import hypot, sqrt, pow
+
+from helpers import INF, numpy
+from spatial import GridIndex
 
 
 class AssertRouteError(Exception):
@@ -20,6 +25,119 @@ class Node(object):
         self.y = y
 
 
+class CoordinatesRow(object):
+    __slots__ = ('x', 'y', 'xs', 'ys')
+
+    def __init__(self, x, y, xs, ys):
+        self.x = x
+        self.y = y
+        self.xs = xs
+        self.ys = ys
+
+    def __getitem__(self, j):
+        return hypot(self.x - self.xs[j], self.y - self.ys[j])
+
+    def __len__(self):
+        return len(self.xs)
+
+
+class CoordinatesMatrix(object):
+    """
+    Distance matrix of a big task - distances are calculated from nodes
+    coordinates when they are needed, so matrix[i][j] works, but nothing
+    of O(n^2) size is kept in memory.
+    """
+    def __init__(self, nodes):
+        self.xs = [node.x for node in nodes]
+        self.ys = [node.y for node in nodes]
+
+    def __getitem__(self, i):
+        return CoordinatesRow(self.xs[i], self.ys[i], self.xs, self.ys)
+
+    def __len__(self):
+        return len(self.xs)
+
+    def __iter__(self):
+        for i in xrange(len(self.xs)):
+            yield self[i]
+
+    def distance(self, i, j):
+        return hypot(self.xs[i] - self.xs[j], self.ys[i] - self.ys[j])
+
+
+class PopIndex(object):
+    """
+    Index of a list of nodes names for pop_closest_to and pop_furthest_to
+    (tasks with coordinates only). Nearest and farthest nodes are found in
+    a grid, but if the same query is repeated (the same origin and
+    direction), they are taken from a heap of distances from the origin -
+    a grid doesn't help much when nodes around the origin (or far from it)
+    are gone. Names are popped from the list by putting the last name in
+    their place, so the order of the list isn't kept.
+    """
+    def __init__(self, task, nodes):
+        self.task = task
+        self.nodes = nodes
+        self.xs, self.ys = task.get_coordinates()
+
+        indices = task.to_indices(nodes)
+        self.grid = GridIndex(self.xs, self.ys, indices)
+        self.position = dict((i, k) for k, i in enumerate(indices))
+
+        self.last_query = None
+        self.heap_query = None
+        self.heap = []
+
+    def is_valid(self, nodes):
+        # list wasn't changed by anything else
+        return nodes is self.nodes and len(nodes) == self.grid.count
+
+    def pop(self, origin, farthest=False):
+        i = self.task.node_index[origin]
+        x = self.xs[i]
+        y = self.ys[i]
+
+        query = (i, farthest)
+        if query == self.last_query and query != self.heap_query:
+            self.make_heap(query, x, y)
+        self.last_query = query
+
+        if query == self.heap_query:
+            node = self.pop_heap()
+            self.grid.remove(node)
+        elif farthest:
+            node = self.grid.pop_farthest(x, y)
+        else:
+            node = self.grid.pop_nearest(x, y)
+
+        # put the last name in place of the popped one
+        nodes = self.nodes
+        k = self.position.pop(node)
+        last = nodes.pop()
+        if k < len(nodes):
+            nodes[k] = last
+            self.position[self.task.node_index[last]] = k
+
+        return self.task.node_names[node]
+
+    def make_heap(self, query, x, y):
+        xs = self.xs
+        ys = self.ys
+        sign = -1 if query[1] else 1
+        self.heap = [(sign * hypot(x - xs[i], y - ys[i]), i)
+                     for i in self.position]
+        heapify(self.heap)
+        self.heap_query = query
+
+    def pop_heap(self):
+        # nodes popped in other ways are still on the heap
+        position = self.position
+        while 1:
+            d, i = heappop(self.heap)
+            if i in position:
+                return i
+
+
 class BaseTask(object):
     # base data (needs to be passed to init)
     start = None
@@ -38,10 +156,45 @@ class BaseTask(object):
     symetric = True  # if true, distance from A to B == B to A unless
                      # specyfied otherwise in distances
 
+    # Engine used to find shortest paths if paths_only is true:
+    # 'floyd', 'dijkstra' or None to choose by density of the graph
+    # (dijkstra is used if there are less edges than sparse_density * n^2).
+    paths_engine = None
+    sparse_density = 0.25
+
+    # Tasks with more nodes (and not paths_only) get a CoordinatesMatrix
+    # instead of a full one - it would take too much time and memory.
+    dense_matrix_limit = 2000
+
     # helper data (calculated)
     all_nodes = {}
     is_circle = None
 
+    # index based representation of the task (calculated)
+    # Nodes are numbered: start gets 0, mid nodes get 1..len(mid_nodes)
+    # and finish gets the last index (or 0 if route is a circle).
+    # matrix[i][j] is a distance from node i to node j.
+    node_names = []
+    node_index = {}
+    mid_indices = []
+    start_idx = 0
+    finish_idx = 0
+    matrix = []
+
+    # paths_only helpers - edges[i] is a list of (j, distance) tuples and
+    # next_hop[i][j] is the node that follows i on the shortest path to j
+    edges = []
+    next_hop = None
+
+    # matrix[a][b] == matrix[b][a] for all nodes (checked on demand)
+    matrix_symetric = None
+
+    # numpy copy of matrix (made on demand for routes_costs)
+    numpy_matrix = None
+
+    # PopIndex of the list of nodes that is being popped
+    pop_index = None
+
     def __init__(self, **kwargs):
         self.mid_nodes = []
         self.all_nodes = {}
@@ -62,29 +215,188 @@ class BaseTask(object):
         for node in self.mid_nodes:
             self.all_nodes[node.name] = node
 
+        # number the nodes
+        self.node_names = [self.start.name]
+        self.node_names.extend(node.name for node in self.mid_nodes)
+        if not self.is_circle:
+            self.node_names.append(self.finish.name)
+        self.node_index = dict(
+                (name, i) for i, name in enumerate(self.node_names))
+
+        self.mid_indices = range(1, len(self.mid_nodes) + 1)
+        self.start_idx = 0
+        self.finish_idx = self.node_index[self.finish.name]
+
         if self.paths_only:
             # Assumes that some nodes can be reached only by going thru other
-            # nodes. If that is the case, then use Floyd algorithm to find
-            # shortest paths between every two nodes.
-            self.run_Floyd()
-        else:  # calculate missing distances
-            # get a list of stop names (including start and finish)
-            stop_names = self.all_nodes.keys()
+            # nodes. If that is the case, then use Floyd or Dijkstra
+            # algorithm to find shortest paths between every two nodes.
+            self.edges = self.get_paths_edges()
+            if self.get_paths_engine() == 'dijkstra':
+                self.run_Dijkstra()
+            else:
+                self.run_Floyd()
+        else:  # calculate all distances
+            self.build_matrix()
+
+    def build_matrix(self):
+        nodes = [self.all_nodes[name] for name in self.node_names]
+        if len(nodes) > self.dense_matrix_limit:
+            self.matrix = CoordinatesMatrix(nodes)
+            return
+
+        self.matrix = [
+            array('d', [sqrt(pow((a.x - b.x), 2) + pow((a.y - b.y), 2))
+                        for b in nodes])
+            for a in nodes
+        ]
+
+    # index based api - use it in solvers hot loops ---------------------------
+
+    def dist(self, i, j):
+        return self.matrix[i][j]
+
+    def get_coordinates(self):
+        # lists of x and y coordinates of nodes (by index) or None if
+        # distances aren't calculated from coordinates
+        if self.paths_only:
+            return None
+        if isinstance(self.matrix, CoordinatesMatrix):
+            return self.matrix.xs, self.matrix.ys
+
+        nodes = [self.all_nodes[name] for name in self.node_names]
+        return [node.x for node in nodes], [node.y for node in nodes]
+
+    def is_symetric(self):
+        # True if distance from a to b is always the same as from b to a
+        # (distances calculated from coordinates are symetric)
+        if self.matrix_symetric is None:
+            matrix = self.matrix
+            self.matrix_symetric = (
+                    not self.paths_only or
+                    all(list(row) == list(column)
+                        for row, column in izip(matrix, izip(*matrix))))
+        return self.matrix_symetric
+
+    def get_candidates(self, count, reverse=False, check_timeout=None):
+        # lists of count nearest nodes of every node (by index) - nearest
+        # to go to, or to go from if reverse is true; check_timeout is
+        # called once in a while if it is given
+        matrix = self.matrix
+        size = len(matrix)
+        count = min(count, size - 1)
+
+        coordinates = self.get_coordinates()
+        if coordinates:
+            xs, ys = coordinates
+            grid = GridIndex(xs, ys, range(size))
+            find = lambda a: [i for d, i in
+                              grid.nearest(xs[a], ys[a], count + 1)]
+        elif reverse and not self.is_symetric():
+            find = lambda a: nsmallest(count + 1, xrange(size),
+                                       key=lambda c: matrix[c][a])
+        else:
+            find = lambda a: nsmallest(count + 1, xrange(size),
+                                       key=matrix[a].__getitem__)
+
+        candidates = []
+        for a in xrange(size):
+            if check_timeout and not a % 1000:
+                check_timeout()
+            candidates.append([i for i in find(a) if i != a][:count])
+        return candidates
+
+    def get_nearest_neighbour_route(self):
+        # route (of indices) that always goes to the nearest unused mid node
+        mids = self.mid_indices
+        route = [self.start_idx]
+
+        coordinates = self.get_coordinates()
+        if coordinates:
+            xs, ys = coordinates
+            grid = GridIndex(xs, ys, mids)
+            while grid.count:
+                route.append(grid.pop_nearest(xs[route[-1]], ys[route[-1]]))
+        else:
+            unused_nodes = set(mids)
+            while unused_nodes:
+                row = self.matrix[route[-1]]
+                node = min(unused_nodes, key=row.__getitem__)
+                unused_nodes.remove(node)
+                route.append(node)
+
+        route.append(self.finish_idx)
+        return route
+
+    def path_cost(self, indices):
+        matrix = self.matrix
+        distance = 0
+        for i in xrange(1, len(indices)):
+            distance += matrix[indices[i-1]][indices[i]]
 
-            for a, b in permutations(stop_names, 2):
-                key = '%s:%s' % (a, b)
-                self.distances[key] = self.calculate_distance(a, b)
+        return distance
+
+    def routes_costs(self, routes, start=None, finish=None):
+        """
+        Costs of many routes at once. Routes is a 2-D array (or a list of
+        equally long lists) of nodes indices. If start or finish is given,
+        the way from start to the first node of every route (or from the
+        last one to finish) is included.
+        Returns numpy array if numpy is available, list otherwise.
+        """
+        if numpy is not None and isinstance(self.matrix, CoordinatesMatrix):
+            # distances of all arcs of all routes from coordinates
+            routes = numpy.asarray(routes, dtype=int)
+            xs = numpy.array(self.matrix.xs, dtype=float)
+            ys = numpy.array(self.matrix.ys, dtype=float)
+            if start is not None:
+                routes = numpy.hstack((
+                    numpy.full((len(routes), 1), start, dtype=int), routes))
+            if finish is not None:
+                routes = numpy.hstack((
+                    routes, numpy.full((len(routes), 1), finish, dtype=int)))
+            return numpy.hypot(numpy.diff(xs[routes], axis=1),
+                               numpy.diff(ys[routes], axis=1)).sum(axis=1)
+
+        if numpy is not None:
+            if self.numpy_matrix is None:
+                self.numpy_matrix = numpy.array(self.matrix, dtype=float)
+            matrix = self.numpy_matrix
+
+            # gather costs of all arcs of all routes and sum them up
+            routes = numpy.asarray(routes, dtype=int)
+            costs = matrix[routes[:, :-1], routes[:, 1:]].sum(axis=1)
+            if start is not None:
+                costs += matrix[start, routes[:, 0]]
+            if finish is not None:
+                costs += matrix[routes[:, -1], finish]
+            return costs
+
+        matrix = self.matrix
+        costs = [sum([matrix[a][b] for a, b in izip(route, route[1:])])
+                 for route in routes]
+        if start is not None:
+            row = matrix[start]
+            costs = [cost + row[route[0]]
+                     for cost, route in izip(costs, routes)]
+        if finish is not None:
+            costs = [cost + matrix[route[-1]][finish]
+                     for cost, route in izip(costs, routes)]
+        return costs
+
+    def to_indices(self, names):
+        index = self.node_index
+        return [index[name] for name in names]
+
+    def to_names(self, indices):
+        names = self.node_names
+        return [names[i] for i in indices]
+
+    # name based api ----------------------------------------------------------
 
     def get_distance(self, a, b):
-        key = '%s:%s' % (a, b)
-        dist = self.distances.get(key)
-        if dist is None:
-            if self.paths_only:
-                return 1e10000
-            else:
-                dist = self.calculate_distance(a, b)
-                self.distances[key] = dist
-        return dist
+        index = self.node_index
+        return self.matrix[index[a]][index[b]]
 
     def calculate_distance(self, a, b):
         node_a = self.all_nodes[a]
@@ -93,19 +405,25 @@ class BaseTask(object):
         return sqrt(pow((node_a.x-node_b.x), 2) + pow((node_a.y-node_b.y), 2))
 
     def get_path_distance(self, path):
-        distance = 0
-        for i in xrange(1, len(path)):
-            distance += self.get_distance(path[i-1], path[i])
+        return self.path_cost(self.to_indices(path))
 
-        return distance
+    def get_pop_index(self, nodes):
+        if not self.pop_index or not self.pop_index.is_valid(nodes):
+            self.pop_index = PopIndex(self, nodes)
+        return self.pop_index
 
     def pop_closest_to(self, origin, nodes):
+        if nodes and not self.paths_only:
+            return self.get_pop_index(nodes).pop(origin)
+
         distance = float('inf')
+        row = self.matrix[self.node_index[origin]]
+        index = self.node_index
 
         i = 0
         closest_idx = 0
         for node_name in nodes:
-            d = self.get_distance(origin, node_name)
+            d = row[index[node_name]]
             if d < distance:
                 distance = d
                 closest_idx = i
@@ -114,12 +432,17 @@ class BaseTask(object):
         return nodes.pop(closest_idx)
 
     def pop_furthest_to(self, origin, nodes):
+        if nodes and not self.paths_only:
+            return self.get_pop_index(nodes).pop(origin, farthest=True)
+
         distance = 0
+        row = self.matrix[self.node_index[origin]]
+        index = self.node_index
 
         i = 0
         closest_idx = 0
         for node_name in nodes:
-            d = self.get_distance(origin, node_name)
+            d = row[index[node_name]]
             if d > distance:
                 distance = d
                 closest_idx = i
@@ -139,11 +462,12 @@ class BaseTask(object):
                     u"Finish node of route doesn't match one from task")
 
         # verify if there are any repeted nodes on route
+        # (circle route begins and ends with the same node)
         route_as_set = set(route)
         if (self.start.name != self.finish.name and
                 len(route_as_set) != len(route)):
             raise AssertRouteError(u'Some nodes on route are repeted')
-        elif len(route_as_set) != len(route):
+        elif len(route_as_set) != len(route) - self.is_circle:
             raise AssertRouteError(u'Some nodes on route are repeted')
 
         # verify if all mid nodes are included
@@ -157,46 +481,201 @@ class BaseTask(object):
         if route_as_set - nodes_as_set:
             raise AssertRouteError(u'Unknown nodes are included to the route')
 
-    def run_Floyd(self):
-        # prepare reference matrix
-        ref = self.all_nodes.keys()
-        size = len(ref)
-        # prepare distance matrix
-        N = 1e10000  # infinity
-        distances = [[N,] * size for i in range(size)]
+    def get_paths_edges(self):
+        # prepare adjacency lists out of distances dict
+        index = self.node_index
+        adjacency = [{} for name in self.node_names]
 
         for key, dist in self.distances.items():
             names = key.split(':')
-            idx1 = ref.index(names[0])
-            idx2 = ref.index(names[1])
-            distances[idx1][idx2] = dist
-
-            if self.symetric and distances[idx1][idx2] == N:
-                distances[idx2][idx1] = dist
-
-        # run Floyd algorithm
-        enum = range(size)
-        for i in enum:
-            for j in enum:
-                for k in enum:
-                    if (distances[j][i] + distances[i][k]) < distances[j][k]:
-                        distances[j][k] = (distances[j][i] + distances[i][k])
-
-        # write distances back to distances dict
-        for i in enum:
-            for j in enum:
-                dist = distances[i][j]
-                if dist != N:
-                    key = ':'.join([ref[i], ref[j]])
-                    self.distances[key] = dist
-
+            idx1 = index[names[0]]
+            idx2 = index[names[1]]
+            adjacency[idx1][idx2] = dist
+
+        # opposite direction is used unless specyfied otherwise
+        if self.symetric:
+            for idx1, neighbours in enumerate(adjacency):
+                for idx2, dist in neighbours.items():
+                    adjacency[idx2].setdefault(idx1, dist)
+
+        return [neighbours.items() for neighbours in adjacency]
+
+    def get_paths_engine(self):
+        if self.paths_engine:
+            return self.paths_engine
+
+        size = len(self.node_names)
+        edges_count = sum(len(neighbours) for neighbours in self.edges)
+        # Floyd runs a lot faster with numpy, so Dijkstra pays off only
+        # for very sparse graphs
+        density = self.sparse_density
+        if numpy is not None:
+            density /= 100
+        if edges_count < density * size * size:
+            return 'dijkstra'
+        return 'floyd'
+
+    def get_paths_matrix(self):
+        # prepare distance matrix (as list of rows) out of edges
+        size = len(self.node_names)
+        distances = [[INF, ] * size for i in xrange(size)]
+
+        for i, neighbours in enumerate(self.edges):
+            row = distances[i]
+            for j, dist in neighbours:
+                row[j] = dist
+
+        return distances
+
+    def validate_paths(self, distances):
         # validate if all nodes are accesible
-        for i in enum:
+        for i, row in enumerate(distances):
             # destination node doesn't need to have a route to other nodes
-            if ref[i] == self.finish.name:
+            if i == self.finish_idx:
                 continue
 
-            for j in enum:
-                if i != j and distances[i][j] == N:
-                    raise AssertTaskDataError(
-                        u'There is no route from {} to {}'.format(ref[i], ref[j]))
+            # path from node to itself doesn't matter
+            if row.count(INF) > (row[i] == INF):
+                j = [j for j, d in enumerate(row) if d == INF and j != i][0]
+                raise AssertTaskDataError(
+                    u'There is no route from {} to {}'.format(
+                        self.node_names[i], self.node_names[j]))
+
+    def run_Floyd(self):
+        distances = self.get_paths_matrix()
+        size = len(distances)
+
+        # first node on the way from j to k - k itself if there is an edge
+        next_hop = [[k if d < INF else -1 for k, d in enumerate(row)]
+                    for row in distances]
+
+        # run Floyd algorithm - every row is updated at once with
+        # min(row_j, row_j[i] + row_i), instead of cell by cell (and the
+        # way to cells that got shorter goes thru the first hop to i)
+        if numpy is not None:
+            distances = numpy.array(distances, dtype=float)
+            next_hop = numpy.array(next_hop, dtype=int)
+            for i in xrange(size):
+                via = distances[:, i, None] + distances[i]
+                shorter = via < distances
+                distances[shorter] = via[shorter]
+                next_hop = numpy.where(shorter, next_hop[:, i, None], next_hop)
+            negative_cycle = (distances.diagonal() < 0).any()
+            distances = distances.tolist()
+            next_hop = next_hop.tolist()
+        else:
+            for i in xrange(size):
+                row_i = distances[i]
+                for j in xrange(size):
+                    row_j = distances[j]
+                    d = row_j[i]
+                    if d == INF:
+                        continue
+                    hop = next_hop[j][i]
+                    via = [d + b for b in row_i]
+                    next_hop[j] = [h if a <= c else hop for a, c, h in
+                                   izip(row_j, via, next_hop[j])]
+                    distances[j] = [a if a <= c else c
+                                    for a, c in izip(row_j, via)]
+            negative_cycle = any(distances[i][i] < 0 for i in xrange(size))
+
+        if negative_cycle:
+            raise AssertTaskDataError(
+                    u'There is a negative cycle in distances')
+
+        # diagonal holds shortest cycles now - node to itself costs
+        # nothing (like in run_Dijkstra)
+        for i in xrange(size):
+            distances[i][i] = 0
+            next_hop[i][i] = -1
+        self.validate_paths(distances)
+
+        self.matrix = [array('d', row) for row in distances]
+        self.next_hop = [array('i', row) for row in next_hop]
+
+    def run_Dijkstra(self):
+        """
+        Run Dijkstra algorithm from every node. Meant for sparse graphs,
+        where it is a lot cheaper then Floyd. If some distances are
+        negative, edges are reweighted first (Johnson algorithm).
+        """
+        size = len(self.node_names)
+        potentials = self.get_Johnson_potentials()
+        if potentials:
+            edges = [[(j, dist + potentials[i] - potentials[j])
+                      for j, dist in neighbours]
+                     for i, neighbours in enumerate(self.edges)]
+        else:
+            edges = self.edges
+
+        distances = []
+        next_hop = []
+        for source in xrange(size):
+            row = [INF, ] * size
+            # first node on the way from source to given node
+            hops = [-1, ] * size
+            row[source] = 0
+            heap = [(0, source)]
+            while heap:
+                dist, i = heappop(heap)
+                if dist > row[i]:
+                    continue
+                hop = hops[i]
+                for j, d in edges[i]:
+                    d += dist
+                    if d < row[j]:
+                        row[j] = d
+                        hops[j] = j if i == source else hop
+                        heappush(heap, (d, j))
+
+            if potentials:
+                p = potentials[source]
+                row = [d - p + potentials[j] for j, d in enumerate(row)]
+
+            distances.append(row)
+            next_hop.append(array('i', hops))
+
+        self.validate_paths(distances)
+
+        self.matrix = [array('d', row) for row in distances]
+        self.next_hop = next_hop
+
+    def get_Johnson_potentials(self):
+        # nothing to do if there are no negative distances
+        if all(dist >= 0 for neighbours in self.edges
+               for j, dist in neighbours):
+            return None
+
+        # Bellman-Ford algorithm from a virtual node connected to all nodes
+        size = len(self.node_names)
+        potentials = [0, ] * size
+        for k in xrange(size):
+            changed = False
+            for i, neighbours in enumerate(self.edges):
+                for j, dist in neighbours:
+                    if potentials[i] + dist < potentials[j]:
+                        potentials[j] = potentials[i] + dist
+                        changed = True
+            if not changed:
+                return potentials
+
+        raise AssertTaskDataError(u'There is a negative cycle in distances')
+
+    def expand_route(self, route):
+        """
+        Returns route with all the nodes that need to be passed on the way
+        between its stops (only paths_only tasks may have those).
+        """
+        if not self.paths_only or not route:
+            return route
+
+        index = self.node_index
+        names = self.node_names
+        full_route = [route[0]]
+        for a, b in izip(route, route[1:]):
+            i, j = index[a], index[b]
+            while i != j:
+                i = self.next_hop[i][j]
+                full_route.append(names[i])
+
+        return full_route
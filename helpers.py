@@ -13,3 +13,10 @@ def print_array(array):
 
 class TimeoutError(Exception):
     pass
+
+# Optional dependencies -------------------------------------------------------
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+from collections import deque
+from itertools import izip
+
+EPSILON = 1e-9
+
+
+class LocalSearch(object):
+    """
+    Improves a route (list of nodes indices) with 2-opt and Or-opt moves
+    until none of them makes it shorter. First and last node of the route
+    stay in place, fragments keep their direction in Or-opt moves and
+    costs of reversed fragments are counted in 2-opt moves, so asymmetric
+    tasks are fine.
+
+    Only moves that make an arc to one of nearest nodes are checked
+    (neighbours lists), and a node is checked again only if an arc next
+    to it was changed (don't look bits).
+    """
+    neighbours_count = 10
+    check_timeout = None  # called once in a while (it may raise TimeoutError)
+    check_interval = 100  # nodes checked between calls of check_timeout
+    moves = ('2opt', 'oropt')
+    segment_lengths = (1, 2, 3)  # Or-opt fragments
+
+    # helpers
+    route = None  # route being improved
+
+    def __init__(self, task, **kwargs):
+        for key, val in kwargs.items():
+            setattr(self, key, val)
+
+        self.task = task
+        self.matrix = task.matrix
+        self.moves_count = 0
+        self.prepare_data()
+
+    def prepare_data(self):
+        task = self.task
+        count = self.neighbours_count
+        self.symetric = task.is_symetric()
+
+        # neighbours[a] - nodes nearest to go to from a,
+        # predecessors[a] - nodes nearest to go from to a
+        self.neighbours = task.get_candidates(
+                count, check_timeout=self.check_timeout)
+        self.predecessors = self.neighbours
+        if not self.symetric:
+            self.predecessors = task.get_candidates(
+                    count, reverse=True, check_timeout=self.check_timeout)
+
+    def improve(self, route):
+        self.route = route = list(route)
+
+        # position of every node on the route (start of a circle is at 0)
+        self.position = position = [0] * len(self.matrix)
+        for i, node in enumerate(route):
+            position[node] = i
+        position[route[0]] = 0
+
+        # nodes which surroundings need to be checked
+        queue = deque(route[:-1])
+        queued = set(queue)
+        checked = 0
+        while queue:
+            node = queue.popleft()
+            queued.discard(node)
+
+            checked += 1
+            if self.check_timeout and not checked % self.check_interval:
+                self.check_timeout()
+
+            changed = None
+            if '2opt' in self.moves:
+                changed = self.two_opt_move(node)
+            if not changed and 'oropt' in self.moves:
+                changed = self.or_opt_move(node)
+
+            if changed:
+                self.moves_count += 1
+                for node in changed:
+                    if node not in queued:
+                        queue.append(node)
+                        queued.add(node)
+
+        return route
+
+    def update_positions(self, first, last):
+        # last position (finish) is never updated - it may be start too
+        position = self.position
+        route = self.route
+        for i in xrange(first, min(last, len(route) - 1)):
+            position[route[i]] = i
+
+    # 2-opt -------------------------------------------------------------------
+
+    def two_opt_move(self, a):
+        """
+        Reverse a fragment of route, so a is followed by (or follows) one
+        of its neighbours. Returns nodes which arcs were changed.
+        """
+        route = self.route
+        matrix = self.matrix
+        position = self.position
+        last = len(route) - 1
+        i = position[a]
+        row = matrix[a]
+
+        # a -> c, fragment b..c is reversed
+        if i < last - 1:
+            b = route[i + 1]
+            removed = row[b]
+            for c in self.neighbours[a]:
+                if row[c] >= removed:
+                    break
+                j = position[c]
+                if j <= i + 1 or j >= last:
+                    continue
+
+                d = route[j + 1]
+                delta = (row[c] + matrix[b][d] - removed - matrix[c][d] +
+                         self.get_reversal_delta(i + 1, j))
+                if delta < -EPSILON:
+                    self.reverse(i + 1, j)
+                    return a, b, c, d
+
+        # c -> a, fragment c..p is reversed
+        if i > 1:
+            p = route[i - 1]
+            removed = matrix[p][a]
+            for c in self.predecessors[a]:
+                if matrix[c][a] >= removed:
+                    break
+                j = position[c]
+                if j < 1 or j >= i - 1:
+                    continue
+
+                x = route[j - 1]
+                delta = (matrix[x][p] + matrix[c][a] - matrix[x][c] -
+                         removed + self.get_reversal_delta(j, i - 1))
+                if delta < -EPSILON:
+                    self.reverse(j, i - 1)
+                    return a, p, c, x
+
+    def get_reversal_delta(self, i, j):
+        # change of cost of fragment route[i..j] when it gets reversed
+        if self.symetric:
+            return 0
+
+        matrix = self.matrix
+        fragment = self.route[i:j + 1]
+        return sum([matrix[b][a] - matrix[a][b]
+                    for a, b in izip(fragment, fragment[1:])])
+
+    def reverse(self, i, j):
+        route = self.route
+        route[i:j + 1] = route[j:i - 1:-1]
+        self.update_positions(i, j + 1)
+
+    # Or-opt ------------------------------------------------------------------
+
+    def or_opt_move(self, a):
+        """
+        Move a fragment that begins with a (of 1 to 3 nodes) between one of
+        its neighbours and the next (or previous) node. Returns nodes which
+        arcs were changed.
+        """
+        route = self.route
+        matrix = self.matrix
+        position = self.position
+        last = len(route) - 1
+        i = position[a]
+        if i < 1:
+            return
+
+        p = route[i - 1]
+        for length in self.segment_lengths:
+            if i + length > last:
+                break
+
+            e = route[i + length - 1]
+            n = route[i + length]
+            gain = matrix[p][a] + matrix[e][n] - matrix[p][n]
+            if gain <= EPSILON:
+                continue
+
+            # c -> a ... e -> after c
+            for c in self.predecessors[a]:
+                if matrix[c][a] >= gain:
+                    break
+                j = position[c]
+                if i - 1 <= j < i + length or j >= last:
+                    continue
+
+                following = route[j + 1]
+                added = (matrix[c][a] + matrix[e][following] -
+                         matrix[c][following])
+                if added < gain - EPSILON:
+                    self.move_fragment(i, length, j)
+                    return a, e, p, n, c, following
+
+            # before c -> a ... e -> c
+            row = matrix[e]
+            for c in self.neighbours[e]:
+                if row[c] >= gain:
+                    break
+                j = position[c]
+                if i <= j <= i + length or j < 1:
+                    continue
+
+                preceding = route[j - 1]
+                added = (matrix[preceding][a] + row[c] -
+                         matrix[preceding][c])
+                if added < gain - EPSILON:
+                    self.move_fragment(i, length, j - 1)
+                    return a, e, p, n, c, preceding
+
+    def move_fragment(self, i, length, j):
+        # put route[i:i + length] right after route[j]
+        route = self.route
+        fragment = route[i:i + length]
+        del route[i:i + length]
+        if j > i:
+            j -= length
+        route[j + 1:j + 1] = fragment
+
+        self.update_positions(min(i, j + 1), max(i, j + 1) + length)
@@ -1,8 +1,10 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
-from random import shuffle, random
-from itertools import permutations
+from array import array
+from itertools import izip
+from multiprocessing import Pool, RawArray, cpu_count
+from random import Random, shuffle, random, randrange
 
 from base_solver import BaseSolver
 
@@ -10,60 +12,127 @@ from base_solver import BaseSolver
 INF = float('inf')
 
 
+# Parallel ants helpers -------------------------------------------------------
+# (pheromone is shared with workers and rewritten by the parent every cycle)
+
+_worker = {}
+
+
+def _init_worker(shared_pheromone, size, start):
+    _worker['pheromone'] = shared_pheromone
+    _worker['size'] = size
+    _worker['start'] = start
+
+
+def _run_ants(job):
+    """
+    Build routes for a chunk of ants. Job is a list of (route, seed) pairs,
+    so every ant uses its own random numbers stream.
+    """
+    size = _worker['size']
+    flat = _worker['pheromone'][:]
+    pheromone = [flat[i * size:(i + 1) * size] for i in xrange(size)]
+
+    routes = []
+    for route, seed in job:
+        ant = Ant(route)
+        ant.run(pheromone, _worker['start'], Random(seed))
+        routes.append(ant.route)
+
+    return routes
+
+
 class Ant(object):
-    route = []
+    route = []  # indices of mid nodes
     score = INF
 
     def __init__(self, route):
         self.route = route
 
-    def evaluate(self, task):
-        start = task.start.name
-        finish = task.finish.name
-
-        route = [start, ] + self.route + [finish, ]
-        self.score = task.get_path_distance(route)
-
-    def update_trail(self, total_distance, arcs, start, finish):
+    def update_trail(self, total_distance, pheromone, start, finish):
         power = self.score / total_distance
+        self.deposit(power, pheromone, start, finish)
 
-        # update arcs on route
-        for i in range(1, len(self.route)):
-            arc = (self.route[i-1], self.route[i])
-            arcs[arc] += power
-
-        # remember to update begining and end arcs
-        arcs[(start, self.route[0])] += power
-        arcs[(self.route[0], finish)] += power
+    def deposit(self, power, pheromone, start, finish):
+        # update arcs on route (begining and end arcs included)
+        previous = start
+        for node in self.route:
+            pheromone[previous][node] += power
+            previous = node
+        pheromone[previous][finish] += power
 
-    def run(self, arcs, start):
-        route = [start,]
-        unused_nodes = set(self.route)
+    def run(self, pheromone, start, rng=None):
+        draw = rng.random if rng else random
+        pick = rng.randrange if rng else randrange
 
-        # use shuffled arcs list to prevent privleged arcs
-        shuffled_arcs = arcs.keys()
-        shuffle(shuffled_arcs)
+        route = []
+        unused_nodes = list(self.route)
 
+        node = start
         while unused_nodes:
-            power_from_origin = 0.0
-            tmp_arcs = {}
-            for arc, power in arcs.iteritems():
-                if arc[0] == route[-1] and arc[1] in unused_nodes:
-                    tmp_arcs[arc] = power
-                    power_from_origin += power
+            # draw next node from unused ones, with probability
+            # proportional to pheromone on the way to it
+            row = pheromone[node]
+            powers = [row[i] for i in unused_nodes]
+            power_from_origin = sum(powers)
+
+            if power_from_origin > 0:
+                n = draw() * power_from_origin
+                for idx, power in enumerate(powers):
+                    n -= power
+                    if n < 0:
+                        break
+            else:
+                idx = pick(len(unused_nodes))
+
+            node = unused_nodes[idx]
+            route.append(node)
+            unused_nodes[idx] = unused_nodes[-1]
+            unused_nodes.pop()
 
-            n = random()
+        self.route = route
 
-            for arc, power in tmp_arcs.items():
-                if power_from_origin == 0:
-                    break
-                elif power / power_from_origin > n:
-                    break
 
-            route.append(arc[1])
-            unused_nodes.remove(arc[1])
+class MaxMinAnt(Ant):
+    def run(self, weights, start, candidates, rng=None):
+        """
+        Build a route choosing next node from candidates (nearest nodes)
+        with probability proportional to weights. If all candidates are
+        used, the unused node with the highest weight is taken.
+        """
+        draw = rng.random if rng else random
 
-        self.route = route[1:]
+        route = []
+        unused_nodes = list(self.route)
+        # position of every unused node on unused_nodes list
+        positions = dict((node, i) for i, node in enumerate(unused_nodes))
+
+        node = start
+        while unused_nodes:
+            row = weights[node]
+            options = [i for i in candidates[node] if i in positions]
+
+            if options:
+                powers = [row[i] for i in options]
+                n = draw() * sum(powers)
+                for next_node, power in izip(options, powers):
+                    n -= power
+                    if n < 0:
+                        break
+            else:
+                next_node = max(unused_nodes, key=row.__getitem__)
+
+            node = next_node
+            route.append(node)
+
+            # remove node from unused ones
+            idx = positions.pop(node)
+            last = unused_nodes.pop()
+            if last != node:
+                unused_nodes[idx] = last
+                positions[last] = idx
+
+        self.route = route
 
 
 class AntSystemSolver(BaseSolver):
@@ -73,16 +142,37 @@ class AntSystemSolver(BaseSolver):
     ants_count = 50
     vaporize_factor = 0.5
 
+    # Ants can be run in a pool of processes (processes = None runs them
+    # here). If seed is given, every ant in every cycle gets its own random
+    # numbers stream, so results don't depend on number of processes.
+    processes = None
+    seed = None
+
     # helpers
     best_route = []
     best_score = INF
+    pool = None
 
     def run_search(self):
+        if self.processes:
+            if self.seed is None:
+                self.seed = randrange(2 ** 32)
+            self.start_pool()
+
+        try:
+            return self.run_colony()
+        finally:
+            if self.pool:
+                self.pool.terminate()
+                self.pool.join()
+                self.pool = None
+
+    def run_colony(self):
         # TODO - adjust settings acording to preblems complexity
         # genetate some random solutions
         self.ants = self.generate_initial_ants(self.task)
         # prepare data for pheromone trails
-        self.prepare_arcs()
+        self.prepare_pheromone()
         # check stop condition (run loop)
         self.cycles = 0
         while self.continue_():
@@ -103,55 +193,91 @@ class AntSystemSolver(BaseSolver):
 
             self.check_timeout()
 
-        route = ([self.task.start.name] + self.best_route +
-                [self.task.finish.name])
-        return route, self.best_score, self.cycles
+        route = ([self.task.start_idx] + self.best_route +
+                [self.task.finish_idx])
+        return self.task.to_names(route), self.best_score, self.cycles
 
     def generate_initial_ants(self, task):
-        nodes = [node.name for node in task.mid_nodes]
+        nodes = task.mid_indices
         ants = []
         for i in range(self.ants_count):
             route = nodes[:]
-            shuffle(route)
+            if self.seed is None:
+                shuffle(route)
+            else:
+                Random(self.get_ant_seed(-1, i)).shuffle(route)
 
             ants.append(Ant(route))
 
         return ants
 
-    def prepare_arcs(self):
-        nodes = self.task.all_nodes.keys()
-        self.arcs = {x: 0 for x in permutations(nodes, 2)}
+    def prepare_pheromone(self):
+        # pheromone[i][j] - pheromone on arc from node i to node j
+        size = len(self.task.node_names)
+        self.pheromone = [array('d', [0]) * size for i in xrange(size)]
 
     def continue_(self):
         return self.cycles <= 100
 
     def evaluate_ants(self):
-        for ant in self.ants:
-            ant.evaluate(self.task)
+        costs = self.task.routes_costs([ant.route for ant in self.ants],
+                                       self.task.start_idx,
+                                       self.task.finish_idx)
+        for ant, cost in izip(self.ants, costs):
+            ant.score = float(cost)
 
     def update_pheromone_trails(self):
         total_distance = 0
         for ant in self.ants:
             total_distance += ant.score
 
-        start = self.task.start.name
-        finish = self.task.finish.name
+        start = self.task.start_idx
+        finish = self.task.finish_idx
 
         for ant in self.ants:
-            ant.update_trail(total_distance, self.arcs, start, finish)
+            ant.update_trail(total_distance, self.pheromone, start, finish)
 
     def vaporize(self):
-        for arc, power in self.arcs.iteritems():
-            if power:
-                self.arcs[arc] = self.get_vaporized_power(power)
-
-    def get_vaporized_power(self, power):
-        return max(0, power * self.vaporize_factor)
+        factor = self.vaporize_factor
+        self.pheromone = [array('d', [power * factor for power in row])
+                          for row in self.pheromone]
 
     def run_ants(self):
-        start = self.task.start.name
-        for ant in self.ants:
-            ant.run(self.arcs, start)
+        if self.pool:
+            return self.run_ants_in_pool()
+
+        start = self.task.start_idx
+        for i, ant in enumerate(self.ants):
+            rng = None
+            if self.seed is not None:
+                rng = Random(self.get_ant_seed(self.cycles, i))
+            ant.run(self.pheromone, start, rng)
+
+    def get_ant_seed(self, cycle, i):
+        return hash((self.seed, cycle, i))
+
+    def start_pool(self):
+        size = len(self.task.node_names)
+        self.shared_pheromone = RawArray('d', size * size)
+        self.pool = Pool(self.processes, _init_worker,
+                         (self.shared_pheromone, size, self.task.start_idx))
+
+    def run_ants_in_pool(self):
+        # share current pheromone with workers
+        size = len(self.task.node_names)
+        for i, row in enumerate(self.pheromone):
+            self.shared_pheromone[i * size:(i + 1) * size] = row
+
+        # split ants between workers
+        jobs = [[] for i in xrange(self.processes)]
+        for i, ant in enumerate(self.ants):
+            seed = self.get_ant_seed(self.cycles, i)
+            jobs[i % self.processes].append((ant.route, seed))
+
+        # collect new routes in the same order ants were sent
+        results = self.pool.map(_run_ants, jobs)
+        for i, ant in enumerate(self.ants):
+            ant.route = results[i % self.processes][i // self.processes]
 
     def update_best_solutions(self):
         for ant in self.ants:
@@ -162,7 +288,94 @@ class AntSystemSolver(BaseSolver):
     def handle_timeout(self):
         # this alghoritm might produce a solution even if it was timedout
         self.cycles = self.cycles
-        route = ([self.task.start.name] + self.best_route +
-                [self.task.finish.name])
-        self.best_solution = route
+        route = ([self.task.start_idx] + self.best_route +
+                [self.task.finish_idx])
+        self.best_solution = self.task.to_names(route)
         self.best_distance = self.best_score
+
+
+class ParallelAntSystemSolver(AntSystemSolver):
+    processes = cpu_count()
+
+
+class MaxMinAntSystemSolver(AntSystemSolver):
+    """
+    MAX-MIN Ant System - only the best ant leaves pheromone, pheromone is
+    kept between tau_min and tau_max, ants take distances into account
+    and choose only from lists of nearest nodes (as long as they can).
+    """
+    ants_count = 25
+    vaporize_factor = 0.98  # part of pheromone that is left after a cycle
+
+    alpha = 1  # pheromone importance
+    beta = 2  # distance importance
+    candidates_count = 15
+    global_best_every = 5  # every n-th cycle global best ant leaves
+                           # pheromone instead of the cycle best
+
+    processes = None  # ants are always run in this process
+
+    def generate_initial_ants(self, task):
+        ants = super(MaxMinAntSystemSolver, self).generate_initial_ants(task)
+        return [MaxMinAnt(ant.route) for ant in ants]
+
+    def prepare_pheromone(self):
+        task = self.task
+        size = len(task.node_names)
+
+        # estimate tau_max with a nearest neighbour route
+        distance = task.path_cost(task.get_nearest_neighbour_route())
+        self.tau_max = 1.0 / ((1 - self.vaporize_factor) * distance)
+        self.tau_min = self.tau_max / (2 * size)
+        self.pheromone = [array('d', [self.tau_max]) * size
+                          for i in xrange(size)]
+
+        # visibility of nodes (1/distance)^beta
+        self.visibility = [
+            array('d', [(1.0 / max(d, 1e-10)) ** self.beta if d < INF else 0
+                        for d in row])
+            for row in task.matrix
+        ]
+
+        # nearest nodes for every node (ants skip start and finish, they
+        # are never unused)
+        self.candidates = task.get_candidates(self.candidates_count)
+
+    def update_pheromone_trails(self):
+        if self.cycles % self.global_best_every or not self.best_route:
+            best = min(self.ants, key=lambda ant: ant.score)
+        else:
+            best = Ant(self.best_route)
+            best.score = self.best_score
+
+        best.deposit(1.0 / best.score, self.pheromone, self.task.start_idx,
+                     self.task.finish_idx)
+
+    def vaporize(self):
+        factor = self.vaporize_factor
+        tau_min = self.tau_min
+        tau_max = self.tau_max
+        self.pheromone = [
+            array('d', [min(tau_max, max(tau_min, power * factor))
+                        for power in row])
+            for row in self.pheromone
+        ]
+
+    def run_ants(self):
+        # weights of arcs are the same for all ants in a cycle
+        if self.alpha == 1:
+            weights = [[p * v for p, v in izip(row, visibility)]
+                       for row, visibility in izip(self.pheromone,
+                                                   self.visibility)]
+        else:
+            alpha = self.alpha
+            weights = [[p ** alpha * v for p, v in izip(row, visibility)]
+                       for row, visibility in izip(self.pheromone,
+                                                   self.visibility)]
+
+        start = self.task.start_idx
+        for i, ant in enumerate(self.ants):
+            rng = None
+            if self.seed is not None:
+                rng = Random(self.get_ant_seed(self.cycles, i))
+            ant.run(weights, start, self.candidates, rng)
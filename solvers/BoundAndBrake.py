@@ -1,47 +1,57 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
-from random import shuffle
+from itertools import islice, izip
 
 from base_solver import BaseSolver
+from local_search import LocalSearch
 
 INF = float('inf')
 
 
 class PartialSolution(object):
-    lower_bound = INF
-    upper_bound = INF
-    partial_route = []
-
-    done = False
-
-    def __init__(self, partial_route=[]):
-        self.partial_route = partial_route
-
-    def build(self, task, ancestor, next_stop):
-        self.partial_route = ancestor.partial_route[:]
-        self.partial_route.insert(-1, next_stop)
-        self.lower_bound = task.get_path_distance(self.partial_route)
-
-        missing_nodes = list(set(task.all_nodes.keys()) - set(self.partial_route))
-        if missing_nodes:
-            upper_bound_route = (
-                self.partial_route[:-1] +
-                missing_nodes +
-                [self.partial_route[-1],]
-            )
-            self.upper_bound = task.get_path_distance(upper_bound_route)
-        else:
-            self.upper_bound = self.lower_bound
-            self.done = True
+    """
+    Node of the search tree - route is not stored, only the last node of
+    it, bitmask of visited mid nodes and its cost (without the way to
+    finish). Route is rebuilt from parents when it is needed.
+    """
+    __slots__ = ('last', 'visited', 'cost', 'parent', 'lower_bound')
+
+    def __init__(self, last, visited, cost, parent=None, lower_bound=0):
+        self.last = last
+        self.visited = visited
+        self.cost = cost
+        self.parent = parent
+        self.lower_bound = lower_bound
+
+    def get_route(self):
+        # indices of nodes from start to the last one
+        route = []
+        solution = self
+        while solution:
+            route.append(solution.last)
+            solution = solution.parent
+        route.reverse()
+        return route
 
 
 class BoundAndBrakeDeepFitstSearch(BaseSolver):
     deterministic = False  # actually it's distance is deterministic,
                            # but time isn't.
 
+    # Number of subgradient steps used to tune nodes penalties of the
+    # lower bound (Held-Karp bound) - 0 turns it off.
+    subgradient_steps = 30
+
+    # If beam width is set, search goes level by level keeping only that
+    # many most promising partial solutions on every level (it is not
+    # exact anymore, but time is predictable). Partial solutions are
+    # extended only with beam_candidates nearest missing stops then.
+    beam_width = None
+    beam_candidates = 10
+
     # helper
-    sort_key = lambda self, x: x.upper_bound
+    sort_key = lambda self, x: x.lower_bound
     cycles = 0
 
     def __init__(self, *args, **kwargs):
@@ -49,21 +59,37 @@ class BoundAndBrakeDeepFitstSearch(BaseSolver):
         self.prepare_data()
 
     def prepare_data(self):
-        self.task.node_names_set = set(self.task.all_nodes.keys())
+        # node with index i is bit (1 << i) of a mask
+        self.all_mids = sum([1 << i for i in self.task.mid_indices])
+
+        # symetric version of distances (lower bound uses undirected
+        # spanning trees) and penalties of nodes
+        matrix = self.task.matrix
+        self.symetric = [[min(a, b) for a, b in izip(row, column)]
+                         for row, column in izip(matrix, izip(*matrix))]
+        self.penalties = [0] * len(matrix)
+        self.bound_cache = {}
 
     def run_search(self):
-        self.current_best = self.get_random_solution()
-        self.current_score = self.task.get_path_distance(self.current_best)
+        self.current_best = self.get_initial_solution()
+        self.current_score = self.task.path_cost(self.current_best)
+        self.best_leaf = None
 
-        solution = PartialSolution([self.task.start.name, self.task.finish.name])
-        solution.lower_bound = self.current_score
+        if self.subgradient_steps:
+            self.tune_penalties()
+        self.prepare_neighbours()
 
-        self.best_upper = solution
-        self.to_check = [solution,]
+        start = self.task.start_idx
+        solution = PartialSolution(start, 0, 0)
+        solution.lower_bound = self.get_remaining_bound(start, self.all_mids)
 
-        self.traverse()
+        if self.beam_width:
+            self.beam_search(solution)
+        else:
+            self.to_check = [solution,]
+            self.traverse()
 
-        return self.current_best, self.current_score, self.cycles
+        return self.get_best_solution(), self.current_score, self.cycles
 
     def traverse(self):
         while 1:
@@ -79,40 +105,236 @@ class BoundAndBrakeDeepFitstSearch(BaseSolver):
                 continue
 
             self.cycles += 1
+            partials = self.expand(solution)
+
+            # most promising partial solutions go last (they are popped first)
+            partials.sort(key=self.sort_key, reverse=True)
+            self.to_check.extend(partials)
+
+            self.check_timeout()
+
+    def beam_search(self, solution):
+        beam = [solution, ]
+        while beam:
             partials = []
-            # iterate over unused stops...
-            for stop in self.get_missing_stops(solution):
-                # and create partial solutions
-                partial = PartialSolution()
-                partial.build(self.task, solution, stop)
-
-                # check if this is a full solution...
-                if partial.done:
-                    # ... and if it is the best so far
-                    if partial.lower_bound < self.current_score:
-                        self.current_best = partial.partial_route
-                        self.current_score = partial.lower_bound
-                # if solutions lower bound is lower then current_best, and lower
-                # then best partial solutions upper bound...
-                elif self.is_worth_traversing(partial):
-                    # ...then add it to the list of potential best solutions
-                    partials.append(partial)
-                # otherwise - forget about it
-                else:
-                    pass
+            for solution in beam:
+                if self.is_worth_traversing(solution):
+                    self.cycles += 1
+                    partials.extend(self.expand(solution))
+
+            # keep only the most promising partial solutions
             partials.sort(key=self.sort_key)
-            self.to_check.extend(partials)
+            beam = partials[:self.beam_width]
+
+            self.check_timeout()
+
+    def expand(self, solution):
+        """
+        Returns partial solutions that are one stop longer then given one
+        and are worth checking. Full solutions update the best one.
+        """
+        matrix = self.task.matrix
+        finish = self.task.finish_idx
+        all_mids = self.all_mids
+
+        partials = []
+        row = matrix[solution.last]
+        # iterate over unused stops...
+        for stop in self.get_missing_stops(solution):
+            visited = solution.visited | 1 << stop
+            cost = solution.cost + row[stop]
+
+            # check if this is a full solution...
+            if visited == all_mids:
+                # ... and if it is the best so far
+                cost += matrix[stop][finish]
+                if cost < self.current_score:
+                    self.current_score = cost
+                    self.best_leaf = PartialSolution(
+                            stop, visited, cost, solution)
+                continue
+
+            # if solutions lower bound is lower then current_best...
+            lower_bound = cost + self.get_remaining_bound(
+                    stop, all_mids & ~visited)
+            if lower_bound < self.current_score:
+                # ...then add it to the list of potential best solutions
+                partials.append(PartialSolution(
+                        stop, visited, cost, solution, lower_bound))
+            # otherwise - forget about it
+
+        return partials
 
     def is_worth_traversing(self, solution):
-        return (solution.lower_bound <= self.current_score
-                    and solution.lower_bound < self.best_upper.upper_bound)
+        return solution.lower_bound < self.current_score
 
     def get_missing_stops(self, solution):
-        return self.task.node_names_set - set(solution.partial_route)
+        missing = self.all_mids & ~solution.visited
 
-    def get_random_solution(self):
-        route = [n.name for n in self.task.mid_nodes]
-        shuffle(route)
-        route = [self.task.start.name, ] + route
-        route.append(self.task.finish.name)
-        return route
+        if self.beam_width and self.beam_candidates:
+            return islice((i for i in self.neighbours[solution.last]
+                           if missing >> i & 1), self.beam_candidates)
+
+        # bits of missing mask
+        stops = []
+        while missing:
+            bit = missing & -missing
+            missing ^= bit
+            stops.append(bit.bit_length() - 1)
+        return stops
+
+    def get_best_solution(self):
+        if self.best_leaf:
+            route = self.best_leaf.get_route() + [self.task.finish_idx, ]
+        else:
+            route = self.current_best
+        return self.task.to_names(route)
+
+    def handle_timeout(self):
+        # best route found so far is still a good anwser
+        self.best_solution = self.get_best_solution()
+        self.best_distance = self.current_score
+
+    # initial solution --------------------------------------------------------
+
+    def get_initial_solution(self):
+        # nearest neighbour route improved with 2-opt and Or-opt moves
+        route = self.task.get_nearest_neighbour_route()
+        return LocalSearch(self.task).improve(route)
+
+    # lower bound -------------------------------------------------------------
+
+    def prepare_neighbours(self):
+        # mid nodes sorted by cost of going to them (penalties included)
+        penalties = self.penalties
+        self.neighbours = [
+            sorted(self.task.mid_indices,
+                   key=lambda i: row[i] + penalties[i])
+            for row in self.task.matrix
+        ]
+
+    def get_remaining_bound(self, last, missing):
+        """
+        Lower bound of the cost of going from last node thru all missing
+        nodes (a mask) to finish: spanning tree of missing nodes plus
+        cheapest arcs from last node and to finish. Every arc cost is
+        increased by penalties of its ends, so every missing node penalty
+        is counted twice on a route and it is subtracted back at the end.
+        Everything but the arc from last node depends only on the missing
+        nodes, so it is cached.
+        """
+        if not missing:
+            return self.task.matrix[last][self.task.finish_idx]
+
+        bound = self.bound_cache.get(missing)
+        if bound is None:
+            bound = self.get_set_bound(missing)
+            self.bound_cache[missing] = bound
+
+        # nearest missing node
+        for i in self.neighbours[last]:
+            if missing >> i & 1:
+                return bound + self.task.matrix[last][i] + self.penalties[i]
+
+    def get_set_bound(self, missing):
+        matrix = self.task.matrix
+        finish = self.task.finish_idx
+        penalties = self.penalties
+        nodes = [i for i in self.task.mid_indices if missing >> i & 1]
+
+        mst = self.get_spanning_tree(nodes)[0]
+        leave = min([matrix[i][finish] + penalties[i] for i in nodes])
+
+        return mst + leave - 2 * sum([penalties[i] for i in nodes])
+
+    def get_spanning_tree(self, nodes):
+        # Prim algorithm on symetric distances with penalties
+        # returns cost of the tree and degrees of nodes in it
+        symetric = self.symetric
+        penalties = self.penalties
+
+        degrees = dict((i, 0) for i in nodes)
+        cost = 0
+        rest = list(nodes[1:])
+        row = symetric[nodes[0]]
+        p = penalties[nodes[0]]
+        keys = [row[i] + p + penalties[i] for i in rest]
+        parents = [nodes[0]] * len(rest)
+
+        while rest:
+            k = keys.index(min(keys))
+            node = rest[k]
+            cost += keys[k]
+            degrees[node] += 1
+            degrees[parents[k]] += 1
+
+            # remove the node from the rest
+            for l in (rest, keys, parents):
+                l[k] = l[-1]
+                l.pop()
+
+            # update distances to the tree
+            row = symetric[node]
+            p = penalties[node]
+            for k, i in enumerate(rest):
+                d = row[i] + p + penalties[i]
+                if d < keys[k]:
+                    keys[k] = d
+                    parents[k] = node
+
+        return cost, degrees
+
+    def tune_penalties(self):
+        """
+        Subgradient optimization of nodes penalties, so spanning trees
+        look more like routes (every mid node with 2 neighbours) and the
+        lower bound gets higher.
+        """
+        matrix = self.task.matrix
+        start = self.task.start_idx
+        finish = self.task.finish_idx
+        nodes = tuple(self.task.mid_indices)
+        if len(nodes) < 2:
+            return
+
+        best_bound = -INF
+        step_factor = 2.0
+        for step in xrange(self.subgradient_steps):
+            penalties = self.penalties
+            cost, degrees = self.get_spanning_tree(nodes)
+
+            # nodes used to enter and leave the tree
+            arrive = min(nodes, key=lambda i: matrix[start][i] + penalties[i])
+            leave = min(nodes, key=lambda i: matrix[i][finish] + penalties[i])
+            degrees[arrive] += 1
+            degrees[leave] += 1
+
+            bound = (cost + matrix[start][arrive] + matrix[leave][finish] +
+                     penalties[arrive] + penalties[leave] -
+                     2 * sum([penalties[i] for i in nodes]))
+            if bound > best_bound:
+                best_bound = bound
+                best_penalties = penalties
+                best_degrees = degrees
+            else:
+                # step was too long - go back to the best penalties
+                step_factor /= 2
+                penalties = best_penalties
+                degrees = best_degrees
+                bound = best_bound
+
+            norm = sum([(d - 2) ** 2 for d in degrees.values()])
+            if not norm:
+                break  # spanning tree is a route already
+
+            size = step_factor * (self.current_score - bound) / norm
+            penalties = list(penalties)
+            for i, d in degrees.items():
+                penalties[i] += size * (d - 2)
+            self.penalties = penalties
+
+        self.penalties = best_penalties
+
+
+class BoundAndBrakeBeamSearch(BoundAndBrakeDeepFitstSearch):
+    beam_width = 100
@@ -2,46 +2,193 @@
 # encoding: utf-8
 
 from itertools import permutations
+from multiprocessing import Pool, Value, cpu_count
+from time import time
 
 from base_solver import BaseSolver
+from helpers import TimeoutError, INF
+
+
+# Parallel search helpers -----------------------------------------------------
+# (workers get the task and shared best distance once, when they start)
+
+_worker = {}
+
+
+def _init_worker(task, shared_best, deadline, share_every):
+    _worker['task'] = task
+    _worker['shared_best'] = shared_best
+    _worker['deadline'] = deadline
+    _worker['share_every'] = share_every
+
+
+def _search_prefix(prefix):
+    """
+    Check all routes that begin with given prefix of mid nodes.
+    Returns (best path, its distance, cycles, timedout flag).
+    """
+    task = _worker['task']
+    shared_best = _worker['shared_best']
+    deadline = _worker['deadline']
+
+    search = PermutationSearch(task, shared_best.value)
+    search.check_every = _worker['share_every']
+
+    # share best distance with other workers from time to time
+    def check():
+        _share_best(search.best_distance)
+        search.bound = min(search.bound, shared_best.value)
+
+        if deadline and deadline < time():
+            raise TimeoutError
+    search.check = check
+
+    # skip prefixes that are already worse then the best route found
+    head = [task.start_idx, ] + list(prefix)
+    head_cost = task.path_cost(head)
+    if search.prune and head_cost >= search.bound:
+        return None, INF, 0, False
+
+    rest = [i for i in task.mid_indices if i not in prefix]
+    try:
+        search.visit(head, head_cost, rest)
+    except TimeoutError:
+        return search.best_path, search.best_distance, search.cycles, True
+
+    _share_best(search.best_distance)
+    return search.best_path, search.best_distance, search.cycles, False
+
+
+def _share_best(distance):
+    shared_best = _worker['shared_best']
+    if distance < shared_best.value:
+        with shared_best.get_lock():
+            if distance < shared_best.value:
+                shared_best.value = distance
+
+
+class PermutationSearch(object):
+    """
+    Depth first search over all orders of mid nodes. Cost of the route
+    prefix is kept on the way, so checking a route costs O(1), and branches
+    which prefix is already longer then the bound are cut off - only if
+    there are no negative distances (paths_only tasks may have them).
+    """
+    check_every = 10000
+
+    def __init__(self, task, bound=INF):
+        self.matrix = task.matrix
+        self.finish = task.finish_idx
+        self.prune = min(min(row) for row in self.matrix) >= 0
+
+        self.best_path = None
+        self.best_distance = INF
+        self.bound = bound  # best known distance (may be found elsewhere)
+        self.cycles = 0
+        self.steps = 0
+
+    def check(self):
+        # called every check_every steps (this is where timeout belongs)
+        pass
+
+    def visit(self, path, cost, rest):
+        row = self.matrix[path[-1]]
+
+        self.steps += 1
+        if not self.steps % self.check_every:
+            self.check()
+
+        # all nodes are used - close the route
+        if not rest:
+            cost += row[self.finish]
+            if cost < self.bound:
+                self.bound = self.best_distance = cost
+                self.best_path = path + [self.finish, ]
+
+            self.cycles += 1
+            return
+
+        for i, node in enumerate(rest):
+            node_cost = cost + row[node]
+            if self.prune and node_cost >= self.bound:
+                continue
+
+            path.append(node)
+            self.visit(path, node_cost, rest[:i] + rest[i + 1:])
+            path.pop()
+
 
 class BruteForceSolver(BaseSolver):
     deterministic = True
 
+    # parallel mode settings (processes = None means single process search)
+    processes = None
+    prefix_length = 2
+    share_every = 10000
+
     def run_search(self):
-        # get list of mid nodes names
+        if self.processes:
+            return self.run_parallel_search()
+
+        search = PermutationSearch(self.task)
+        search.check_every = 1000
+        search.check = self.check_timeout
+
+        # go thru all routes, keeping best one on timeout as well
+        try:
+            search.visit([self.task.start_idx, ], 0, self.task.mid_indices)
+        finally:
+            self.cycles = search.cycles
+            self.best_distance = search.best_distance
+            if search.best_path:
+                self.best_solution = self.task.to_names(search.best_path)
+
+        return self.best_solution, self.best_distance, self.cycles
 
+    def run_parallel_search(self):
+        # split search space by beginnings of the routes
+        prefix_length = min(self.prefix_length, len(self.task.mid_indices))
+        prefixes = permutations(self.task.mid_indices, prefix_length)
 
-        mid_nodes = []
-        for node in self.task.mid_nodes:
-            mid_nodes.append(node.name)
+        deadline = None
+        if self.task.timeout:
+            deadline = time() + self.task.timeout
 
-        # iterate over permutations generator
-        self.best_distance = float('inf')
+        shared_best = Value('d', INF)
+        pool = Pool(self.processes, _init_worker,
+                    (self.task, shared_best, deadline, self.share_every))
+
+        self.best_distance = INF
         self.best_solution = None
         self.cycles = 0
-        for permutation in permutations(mid_nodes):
-            # check permutation distance
-            path = [self.task.start.name, ]
-            path.extend(permutation)
-            path.append(self.task.finish.name)
-            distance = self.task.get_path_distance(path)
-
-            # check if this is the best solution so far
-            if distance < self.best_distance:
-                self.best_distance = distance
-                self.best_solution = path
+        timedout = False
+        try:
+            for path, distance, cycles, worker_timedout in pool.imap_unordered(
+                    _search_prefix, prefixes):
+                if distance < self.best_distance:
+                    self.best_distance = distance
+                    self.best_solution = self.task.to_names(path)
 
-            self.cycles += 1
+                self.cycles += cycles
+                timedout = timedout or worker_timedout
+                if timedout:
+                    break
+        finally:
+            pool.terminate()
+            pool.join()
 
-            self.check_timeout()
+        if timedout:
+            self.timedout = True
+            raise TimeoutError
 
         return self.best_solution, self.best_distance, self.cycles
 
-
     def handle_timeout(self):
         # this alghoritm might produce a solution even if it was timedout
         # and it uses the right variable names
         # so nothing to do here
         pass
 
+
+class ParallelBruteForceSolver(BruteForceSolver):
+    processes = cpu_count()
@@ -1,25 +1,143 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
-from random import shuffle, random, randint
+from array import array
+from bisect import bisect
+from heapq import nsmallest
+from itertools import chain, izip
+from multiprocessing import Pool, cpu_count
+import random as random_module
+from random import shuffle, random, randint, sample, choice, randrange
+from time import time
 
 from base_solver import BaseSolver
+from helpers import TimeoutError, numpy
 
 
 INF = float('inf')
 
 
+# Islands helpers -------------------------------------------------------------
+# (every worker evolves one island at a time, parent process migrates)
+
+_worker = {}
+
+
+def _init_worker(task, settings, deadline):
+    _worker['task'] = task
+    _worker['settings'] = settings
+    _worker['deadline'] = deadline
+
+
+def _evolve_island(job):
+    """
+    Run a few generations of an island. Job is (routes, generations,
+    seed). Returns (routes sorted by score, best route, its score,
+    generations run, timedout flag).
+    """
+    routes, generations, seed = job
+    random_module.seed(seed)
+    deadline = _worker['deadline']
+
+    solver = GeneticSolver(_worker['task'])
+    for key, val in _worker['settings'].items():
+        setattr(solver, key, val)
+    solver.best_score = INF
+    solver.best_route = None
+    solver.chromosomes = set(solver.task.mid_indices)
+    solver.population = [Solution(route, True) for route in routes]
+    solver.evaluate_solutions()
+    solver.population.sort(key=solver.sort_key)
+
+    timedout = False
+    done = 0
+    while done < generations:
+        solver.run_generation()
+        done += 1
+        if deadline and deadline < time():
+            timedout = True
+            break
+
+    return ([solution.route for solution in solver.population],
+            solver.best_route, solver.best_score, done, timedout)
+
+
+# Permutation preserving crossovers -------------------------------------------
+# (routes are lists of the same nodes, children are always valid routes)
+
+def order_child(route_1, route_2, i, j):
+    """
+    OX - child gets route_1[i:j] in place, other positions are filled
+    with the rest of nodes in route_2 order (starting after j).
+    """
+    segment = route_1[i:j]
+    used = set(segment)
+    rest = [n for n in chain(route_2[j:], route_2[:j]) if n not in used]
+    k = len(route_1) - j
+    return rest[k:] + segment + rest[:k]
+
+
+def pmx_child(route_1, route_2, i, j):
+    """
+    PMX - child gets route_1[i:j] in place and route_2 nodes elsewhere.
+    Nodes that are already used are swapped by the segments mapping.
+    """
+    child = route_2[:]
+    child[i:j] = route_1[i:j]
+    mapping = dict(izip(route_1[i:j], route_2[i:j]))
+    for k in chain(xrange(i), xrange(j, len(route_2))):
+        node = route_2[k]
+        while node in mapping:
+            node = mapping[node]
+        child[k] = node
+    return child
+
+
+def edge_child(route_1, route_2):
+    """
+    ERX - child is built from arcs of both parents. Next node is the
+    neighbour of the last one that has the least neighbours left (random
+    unused node if there are none).
+    """
+    edges = dict((n, set()) for n in route_1)
+    for route in (route_1, route_2):
+        for a, b in izip(route, route[1:]):
+            edges[a].add(b)
+            edges[b].add(a)
+
+    node = route_1[0]
+    child = [node, ]
+    unused = set(route_1)
+    unused.remove(node)
+    while unused:
+        for n in edges[node]:
+            edges[n].discard(node)
+        options = edges.pop(node)
+        if options:
+            node = min(options, key=lambda n: (len(edges[n]), random()))
+        else:
+            node = choice(tuple(unused))
+        unused.remove(node)
+        child.append(node)
+
+    return child
+
+
 class Solution(object):
-    route = []
+    route = []  # indices of mid nodes
     score = INF
 
     fixed = False
     evaluated = False
 
-    def __init__(self, route):
+    # prefix[k] - cost of the way from start to route[k]
+    prefix = None
+
+    def __init__(self, route, fixed=False):
         self.route = route
+        self.fixed = fixed
 
-    def crossing(self, other):
+    def crossing(self, other, task):
         # choose a node that will be the cut
         cut_idx = randint(1, len(self.route) - 2)
         node = self.route[cut_idx]
@@ -28,60 +146,119 @@ class Solution(object):
         # glue new routes from pieces of old routes
         new_route_1 = self.route[:cut_idx] + other.route[other_cut_idx:]
         new_route_2 = other.route[:other_cut_idx] + self.route[cut_idx:]
-        # create new solutions
+        # create new solutions (their scores are glued from parents too)
         child1 = Solution(new_route_1)
+        child1.score = self.join_cost(cut_idx, other, other_cut_idx, task)
+        child1.evaluated = True
         child2 = Solution(new_route_2)
+        child2.score = other.join_cost(other_cut_idx, self, cut_idx, task)
+        child2.evaluated = True
 
         return child1, child2
 
+    def order_crossing(self, other, task):
+        i, j = sorted(sample(xrange(len(self.route) + 1), 2))
+        return (Solution(order_child(self.route, other.route, i, j), True),
+                Solution(order_child(other.route, self.route, i, j), True))
+
+    def pmx_crossing(self, other, task):
+        i, j = sorted(sample(xrange(len(self.route) + 1), 2))
+        return (Solution(pmx_child(self.route, other.route, i, j), True),
+                Solution(pmx_child(other.route, self.route, i, j), True))
+
+    def edge_crossing(self, other, task):
+        return (Solution(edge_child(self.route, other.route), True),
+                Solution(edge_child(other.route, self.route), True))
+
+    def join_cost(self, cut_idx, other, other_cut_idx, task):
+        # cost of self.route[:cut_idx] + other.route[other_cut_idx:]
+        if cut_idx:
+            last = self.route[cut_idx - 1]
+            head_cost = self.get_prefix(task)[cut_idx - 1]
+        else:
+            last = task.start_idx
+            head_cost = 0
+        first = other.route[other_cut_idx]
+        tail_cost = other.score - other.get_prefix(task)[other_cut_idx]
+
+        return head_cost + task.matrix[last][first] + tail_cost
+
+    def get_prefix(self, task):
+        if self.prefix is None:
+            matrix = task.matrix
+            prefix = []
+            cost = 0
+            previous = task.start_idx
+            for node in self.route:
+                cost += matrix[previous][node]
+                prefix.append(cost)
+                previous = node
+            self.prefix = prefix
+            self.score = cost + matrix[previous][task.finish_idx]
+            self.evaluated = True
+
+        return self.prefix
+
     def mutation(self):
         node = self.route.pop(randint(0, len(self.route) - 1))
         self.route.insert(randint(0, len(self.route)), node)
         self.evaluated = False
+        self.prefix = None
 
     def fix(self, task, mid_nodes):
+        """
+        Remove repeated nodes and insert missing ones where they cost the
+        least. Score is updated with costs of these changes only.
+        """
         # don't fix solution multiple times
         if self.fixed:
             return
 
+        matrix = task.matrix
+        start = task.start_idx
+        finish = task.finish_idx
+        score = self.score
+
         # prepare helper sets
         route_set = set(self.route)
         missing = mid_nodes - route_set
         # remove all repeted nodes from route
         route = []
-        for node in self.route:
+        previous = start
+        last_idx = len(self.route) - 1
+        for i, node in enumerate(self.route):
             if node in route_set:
                 route.append(node)
                 route_set.remove(node)
+                previous = node
+            else:
+                following = self.route[i + 1] if i < last_idx else finish
+                score += (matrix[previous][following] -
+                          matrix[previous][node] - matrix[node][following])
 
         # make sure all needed nodes are included
-        start = [task.start.name, ]
-        finish = [task.finish.name, ]
         for node in missing:
+            row = matrix[node]
             distance = INF
-            best_route = route
-            i = 0
+            best_idx = 0
+            previous = start
             # find a best place to fit this node
-            while i <= len(route):
-                test_route = start + route[:i] + [node, ] + route[i:] + finish
-                route_dist = task.get_path_distance(test_route)
-                if distance > route_dist:
-                    distance = route_dist
-                    best_route = test_route
-                i += 1
-            route = best_route[1:-1]
-
-        self.route = route
+            for i, following in enumerate(route + [finish, ]):
+                d = (matrix[previous][node] + row[following] -
+                     matrix[previous][following])
+                if d < distance:
+                    distance = d
+                    best_idx = i
+                previous = following
+            route.insert(best_idx, node)
+            score += distance
+
+        if route != self.route:
+            self.route = route
+            self.score = score
+            self.prefix = None
         self.fixed = True
 
-    def evaluate(self, task):
-        start = task.start.name
-        finish = task.finish.name
-        if not self.evaluated:
-            route = [start, ] + self.route + [finish, ]
-            self.score = task.get_path_distance(route)
-            self.evaluated = True
-
 
 class GeneticSolver(BaseSolver):
     deterministic = False
@@ -90,6 +267,16 @@ class GeneticSolver(BaseSolver):
     population_count = 30
     mutation_ratio = 1/30
 
+    # crossover operator - 'cut' glues parents at a common node (children
+    # need to be fixed), 'ox', 'pmx' and 'erx' always give valid routes
+    crossover = 'cut'
+    crossover_methods = {
+        'cut': 'crossing',
+        'ox': 'order_crossing',
+        'pmx': 'pmx_crossing',
+        'erx': 'edge_crossing',
+    }
+
     # helpers
     sort_key = lambda self, x: x.score
 
@@ -100,7 +287,7 @@ class GeneticSolver(BaseSolver):
         self.best_score = INF
         self.best_route = None
 
-        self.chromosomes = set([mn.name for mn in self.task.mid_nodes])
+        self.chromosomes = set(self.task.mid_indices)
 
         # generate initial population
         self.population = self.generate_initial_population(self.chromosomes)
@@ -110,37 +297,41 @@ class GeneticSolver(BaseSolver):
 
         # check finish condition
         while self.continue_():
-            # apply crossing
-            self.crossing()
+            self.run_generation()
 
-            # apply mutation
-            self.mutation()
+            self.generation += 1
 
-            # fix wrong solutions
-            self.fix_solutions()
+            self.check_timeout()
 
-            # evaluate solutions
-            self.evaluate_solutions()
+        route = self.task.to_names(
+                [self.task.start_idx, ] + self.best_route +
+                [self.task.finish_idx, ])
 
-            # sort solutions
-            self.population.sort(key=self.sort_key)
+        return route, self.best_score, self.generation
 
-            # limit population
-            self.population = self.population[:self.population_count]
+    def run_generation(self):
+        # apply crossing
+        self.crossing()
 
-            # update best
-            if self.population[0].score < self.best_score:
-                best = self.population[0]
-                self.best_score, self.best_route = best.score, best.route[:]
+        # apply mutation
+        self.mutation()
 
-            self.generation += 1
+        # fix wrong solutions
+        self.fix_solutions()
 
-            self.check_timeout()
+        # evaluate solutions
+        self.evaluate_solutions()
 
-        route = ([self.task.start.name, ] +
-                self.best_route + [self.task.finish.name, ])
+        # sort solutions
+        self.population.sort(key=self.sort_key)
 
-        return route, self.best_score, self.generation
+        # limit population
+        self.population = self.population[:self.population_count]
+
+        # update best
+        if self.population[0].score < self.best_score:
+            best = self.population[0]
+            self.best_score, self.best_route = best.score, best.route[:]
 
     def generate_initial_population(self, chromosomes):
         population = []
@@ -180,7 +371,9 @@ class GeneticSolver(BaseSolver):
             idx2, solution2 = choose_solution()
 
             if idx1 != idx2:
-                children = solution1.crossing(solution2)
+                children = getattr(
+                        solution1, self.crossover_methods[self.crossover])(
+                                solution2, self.task)
                 new_generation.extend(children)
 
         # update population with new solutions
@@ -196,13 +389,273 @@ class GeneticSolver(BaseSolver):
             solution.fix(self.task, self.chromosomes)
 
     def evaluate_solutions(self):
-        for solution in self.population:
-            solution.evaluate(self.task)
+        # score all changed solutions at once
+        solutions = [solution for solution in self.population
+                     if not solution.evaluated]
+        if not solutions:
+            return
+
+        costs = self.task.routes_costs(
+                [solution.route for solution in solutions],
+                self.task.start_idx, self.task.finish_idx)
+        for solution, cost in izip(solutions, costs):
+            solution.score = float(cost)
+            solution.evaluated = True
 
     def handle_timeout(self):
         # this alghoritm might produce a solution even if it was timedout
         self.cycles = self.generation
-        route = ([self.task.start.name, ] +
-                self.best_route + [self.task.finish.name, ])
-        self.best_solution = route
+        route = ([self.task.start_idx, ] +
+                self.best_route + [self.task.finish_idx, ])
+        self.best_solution = self.task.to_names(route)
         self.best_distance = self.best_score
+
+
+class GeneticOXSolver(GeneticSolver):
+    crossover = 'ox'
+
+
+class GeneticPMXSolver(GeneticSolver):
+    crossover = 'pmx'
+
+
+class GeneticERXSolver(GeneticSolver):
+    crossover = 'erx'
+
+
+class ArrayGeneticSolver(GeneticSolver):
+    """
+    Genetic alghoritm for big populations. Population is a 2-D array of
+    mid nodes indices (numpy array if numpy is available, list of int
+    arrays otherwise), scores of all routes are computed at once, parents
+    are drawn by binary search over cumulative fitness and survivors are
+    chosen by partial selection instead of sorting.
+    """
+    population_count = 1000
+    mutation_ratio = 0.05
+    crossover = 'ox'  # only permutation preserving ones - 'ox', 'pmx', 'erx'
+
+    def run_search(self):
+        self.generation = 0
+        self.prepare_data()
+
+        population = self.generate_population()
+        scores = self.evaluate_population(population)
+        self.update_best(population, scores)
+
+        while self.continue_():
+            parents = self.select_parents(scores, self.population_count)
+            children = self.breed(population, parents)
+            children_scores = self.evaluate_population(children)
+
+            population, scores = self.select_survivors(
+                    population, scores, children, children_scores)
+            self.update_best(population, scores)
+
+            self.generation += 1
+
+            self.check_timeout()
+
+        route = self.task.to_names(
+                [self.task.start_idx, ] + self.best_route +
+                [self.task.finish_idx, ])
+
+        return route, self.best_score, self.generation
+
+    def prepare_data(self):
+        self.best_score = INF
+        self.best_route = None
+
+    def to_population(self, routes):
+        if numpy is not None:
+            return numpy.array(routes, dtype=int)
+        return [array('i', route) for route in routes]
+
+    def generate_population(self):
+        routes = []
+        for i in xrange(self.population_count):
+            route = self.task.mid_indices[:]
+            shuffle(route)
+            routes.append(route)
+
+        return self.to_population(routes)
+
+    def evaluate_population(self, population):
+        return self.task.routes_costs(population, self.task.start_idx,
+                                      self.task.finish_idx)
+
+    def select_parents(self, scores, count):
+        """
+        Draw count indices of routes - the shorter the route, the more
+        probable it is chosen.
+        """
+        if numpy is not None:
+            cdf = numpy.cumsum(1.0 / scores)
+            picks = numpy.searchsorted(
+                    cdf, numpy.random.random(count) * cdf[-1], side='right')
+            return numpy.minimum(picks, len(cdf) - 1).tolist()
+
+        cdf = []
+        total = 0
+        for score in scores:
+            total += 1.0 / score
+            cdf.append(total)
+        last = len(cdf) - 1
+        return [min(bisect(cdf, random() * total), last)
+                for i in xrange(count)]
+
+    def breed(self, population, parents):
+        size = len(self.task.mid_indices)
+        # crossovers work on lists (and don't change parents)
+        if numpy is not None:
+            routes = population.tolist()
+        else:
+            routes = map(list, population)
+
+        children = []
+        for idx1, idx2 in izip(parents[::2], parents[1::2]):
+            route_1 = routes[idx1]
+            route_2 = routes[idx2]
+
+            if self.crossover == 'erx':
+                children.append(edge_child(route_1, route_2))
+                children.append(edge_child(route_2, route_1))
+            else:
+                make_child = order_child
+                if self.crossover == 'pmx':
+                    make_child = pmx_child
+                i, j = sorted(sample(xrange(size + 1), 2))
+                children.append(make_child(route_1, route_2, i, j))
+                children.append(make_child(route_2, route_1, i, j))
+
+        # move random node to random place
+        for route in children:
+            if self.mutation_ratio >= random():
+                route.insert(randint(0, size - 1),
+                             route.pop(randint(0, size - 1)))
+
+        return self.to_population(children)
+
+    def select_survivors(self, population, scores, children,
+                         children_scores):
+        # best population_count routes of parents and children
+        count = self.population_count
+        if numpy is not None:
+            population = numpy.vstack((population, children))
+            scores = numpy.concatenate((scores, children_scores))
+            if len(scores) > count:
+                keep = numpy.argpartition(scores, count - 1)[:count]
+                population = population[keep]
+                scores = scores[keep]
+            return population, scores
+
+        population = population + children
+        scores = scores + children_scores
+        keep = nsmallest(count, xrange(len(scores)), key=scores.__getitem__)
+        return [population[i] for i in keep], [scores[i] for i in keep]
+
+    def update_best(self, population, scores):
+        if numpy is not None:
+            i = int(scores.argmin())
+        else:
+            i = min(xrange(len(scores)), key=scores.__getitem__)
+
+        if scores[i] < self.best_score:
+            self.best_score = float(scores[i])
+            self.best_route = [int(node) for node in population[i]]
+
+
+class IslandGeneticSolver(GeneticSolver):
+    """
+    Island model - islands (populations) evolve independently in a pool
+    of processes, every migration_every generations best routes of every
+    island replace the worst routes of its neighbours.
+    """
+    islands_count = cpu_count()
+    processes = cpu_count()  # None runs islands in this process
+    migration_every = 10
+    migrants_count = 2
+    topology = 'ring'  # 'ring' - island i sends to island i + 1,
+                       # 'full' - every island sends to all the others
+
+    def run_search(self):
+        self.generation = 0
+        self.best_score = INF
+        self.best_route = None
+
+        chromosomes = set(self.task.mid_indices)
+        islands = [[solution.route for solution in
+                    self.generate_initial_population(chromosomes)]
+                   for i in xrange(self.islands_count)]
+
+        deadline = None
+        if self.task.timeout:
+            deadline = time() + self.task.timeout
+        settings = {
+            'population_count': self.population_count,
+            'mutation_ratio': self.mutation_ratio,
+            'crossover': self.crossover,
+        }
+
+        pool = None
+        if self.processes:
+            pool = Pool(self.processes, _init_worker,
+                        (self.task, settings, deadline))
+            run_islands = pool.map
+        else:
+            _init_worker(self.task, settings, deadline)
+            run_islands = map
+
+        try:
+            while self.continue_():
+                jobs = [(routes, self.migration_every, randrange(2 ** 32))
+                        for routes in islands]
+
+                # islands evolve side by side - generations of the round
+                # are those of the island that got the furthest
+                islands = []
+                timedout = False
+                generations = 0
+                for routes, route, score, done, island_timedout in (
+                        run_islands(_evolve_island, jobs)):
+                    islands.append(routes)
+                    if score < self.best_score:
+                        self.best_score = score
+                        self.best_route = route
+                    timedout = timedout or island_timedout
+                    generations = max(generations, done)
+                self.generation += generations
+
+                if timedout:
+                    self.timedout = True
+                    raise TimeoutError
+
+                self.migrate(islands)
+
+                self.check_timeout()
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+
+        route = self.task.to_names(
+                [self.task.start_idx, ] + self.best_route +
+                [self.task.finish_idx, ])
+
+        return route, self.best_score, self.generation
+
+    def migrate(self, islands):
+        # routes on islands are sorted - best first
+        count = self.migrants_count
+        migrants = [routes[:count] for routes in islands]
+
+        for i, routes in enumerate(islands):
+            if self.topology == 'ring':
+                incoming = migrants[i - 1]
+            else:
+                incoming = [route for j, others in enumerate(migrants)
+                            if j != i for route in others]
+
+            incoming = incoming[:len(routes) - count]
+            if incoming:
+                routes[-len(incoming):] = [route[:] for route in incoming]
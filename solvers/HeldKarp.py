@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+from array import array
+from itertools import combinations
+
+from base_solver import BaseSolver
+from helpers import TimeoutError, numpy
+
+INF = float('inf')
+
+
+class HeldKarpSolver(BaseSolver):
+    """
+    Dynamic programming over subsets of mid nodes.
+
+    cost[S][j] is the length of the shortest path that begins at start,
+    visits all mid nodes from subset S and ends at node j (from S).
+    Subsets are processed layer by layer (by number of nodes), so only
+    costs of the previous layer need to be kept in memory - just parents
+    are remembered for all layers (to rebuild the route).
+
+    With numpy, costs of a whole layer ending at node j are calculated at
+    once (in chunks of rows) - pure python loops are used otherwise.
+    """
+    deterministic = True
+
+    chunk_size = 1 << 16  # rows of a layer calculated at once with numpy
+
+    # Tables grow as n * 2^n - bigger tasks get a nearest neighbour route
+    # (as if time was up) instead of running out of memory.
+    max_mid_nodes = 22
+
+    def run_search(self):
+        task = self.task
+        mids = task.mid_indices
+        size = len(mids)
+        start = task.start_idx
+        finish = task.finish_idx
+
+        if not size:
+            route = [start, finish]
+            return task.to_names(route), task.path_cost(route), 0
+
+        if size > self.max_mid_nodes:
+            self.timedout = True
+            raise TimeoutError
+
+        # distances between mid nodes - columns[j][i] is distance from i to j
+        columns = [[task.dist(a, b) for a in mids] for b in mids]
+        bits = [1 << j for j in xrange(size)]
+        first = [task.dist(start, node) for node in mids]
+
+        if numpy is not None:
+            costs, parents, rank, cycles = self.run_layers_numpy(columns,
+                                                                 first)
+        else:
+            costs, parents, rank, cycles = self.run_layers(columns, first)
+
+        # close the route
+        distance = INF
+        last = 0
+        for j in xrange(size):
+            cost = costs[j] + task.dist(mids[j], finish)
+            if cost < distance:
+                distance = cost
+                last = j
+
+        # walk back thru parents
+        route = [finish]
+        mask = (1 << size) - 1
+        for layer in xrange(size, 0, -1):
+            route.append(mids[last])
+            if layer > 1:
+                parent = parents[layer - 1][rank[mask] * size + last]
+                mask ^= bits[last]
+                last = parent
+        route.append(start)
+        route.reverse()
+
+        return task.to_names(route), distance, cycles
+
+    def run_layers(self, columns, first):
+        """
+        Returns costs of the last layer, parents of all layers (flat rows
+        of subsets), rank of every subset and number of subsets.
+        """
+        size = len(columns)
+        bits = [1 << j for j in xrange(size)]
+
+        # position of every subset in its layer
+        rank = array('i', [0]) * (1 << size)
+
+        # first layer - subsets with a single node
+        costs = array('d', [INF]) * (size * size)
+        for j in xrange(size):
+            rank[bits[j]] = j
+            costs[j * size + j] = first[j]
+        parents = [None]
+        cycles = size
+
+        for layer in xrange(2, size + 1):
+            layer_costs = array('d')
+            layer_parents = array('b')
+            for pos, subset in enumerate(combinations(xrange(size), layer)):
+                mask = sum([bits[j] for j in subset])
+                rank[mask] = pos
+
+                row_costs = [INF] * size
+                row_parents = [-1] * size
+                for j in subset:
+                    prev = rank[mask ^ bits[j]] * size
+                    column = columns[j]
+                    best = INF
+                    parent = -1
+                    for i in subset:
+                        if i == j:
+                            continue
+                        cost = costs[prev + i] + column[i]
+                        if cost < best:
+                            best = cost
+                            parent = i
+                    row_costs[j] = best
+                    row_parents[j] = parent
+
+                layer_costs.extend(row_costs)
+                layer_parents.extend(row_parents)
+                cycles += 1
+
+                self.check_timeout()
+
+            # previous layer costs are no longer needed
+            costs = layer_costs
+            parents.append(layer_parents)
+
+        return costs, parents, rank, cycles
+
+    def run_layers_numpy(self, columns, first):
+        # the same as run_layers, but every node j of a layer is done at
+        # once: cost of subset S ending at j is a min over a row of costs
+        # of S - j (gathered by rank) plus distances to j
+        size = len(columns)
+        distances = numpy.array(columns, dtype=float)
+        all_masks = numpy.arange(1 << size)
+
+        # number of nodes in every subset
+        counts = numpy.zeros(1 << size, dtype=numpy.int8)
+        for j in xrange(size):
+            counts += (all_masks >> j) & 1
+
+        # first layer - subsets with a single node
+        rank = numpy.zeros(1 << size, dtype=numpy.int32)
+        rank[1 << numpy.arange(size)] = numpy.arange(size)
+        costs = numpy.full((size, size), INF)
+        costs[numpy.arange(size), numpy.arange(size)] = first
+        parents = [None]
+        cycles = size
+
+        for layer in xrange(2, size + 1):
+            masks = numpy.flatnonzero(counts == layer)
+            rank[masks] = numpy.arange(len(masks))
+            layer_costs = numpy.full((len(masks), size), INF)
+            layer_parents = numpy.full((len(masks), size), -1,
+                                       dtype=numpy.int8)
+
+            for j in xrange(size):
+                bit = 1 << j
+                rows = numpy.flatnonzero(masks & bit)
+                for pos in xrange(0, len(rows), self.chunk_size):
+                    chunk = rows[pos:pos + self.chunk_size]
+                    # nodes out of S - j have infinite costs already
+                    prev = costs[rank[masks[chunk] ^ bit]] + distances[j]
+                    best = prev.argmin(axis=1)
+                    layer_costs[chunk, j] = prev[numpy.arange(len(best)), best]
+                    layer_parents[chunk, j] = best
+
+                    self.check_timeout()
+
+            cycles += len(masks)
+            costs = layer_costs
+            parents.append(layer_parents.ravel())
+
+        return costs.ravel(), parents, rank, cycles
+
+    def handle_timeout(self):
+        # nearest neighbour route is better then nothing
+        task = self.task
+        route = task.get_nearest_neighbour_route()
+
+        self.best_solution = task.to_names(route)
+        self.best_distance = task.path_cost(route)
@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+from collections import deque
+from random import randint
+
+from base_solver import BaseSolver
+from local_search import LocalSearch
+
+INF = float('inf')
+EPSILON = 1e-9
+
+
+class LinKernighanSolver(BaseSolver):
+    """
+    Lin-Kernighan style search - a chain of 2-opt moves is made as long
+    as total gain stays positive, and the tour is rolled back to the best
+    point of the chain. Only arcs to candidates (nearest nodes) are added.
+    When no chain improves the tour, it is kicked with a double bridge
+    move and improved again (the kick is undone if it didn't help).
+
+    Tour is a cycle kept in an array (with position of every node). An
+    open route is a cycle with a fixed arc from finish to start.
+    Asymmetric tasks are improved with LocalSearch moves instead of chains
+    of 2-opt moves (those reverse parts of the tour).
+    """
+    deterministic = False
+
+    candidates_count = 8
+    max_depth = 30  # max number of 2-opt moves in a chain
+    kicks_count = 1000
+    kick_span = 50  # max length of fragments swapped by a kick
+
+    # helpers
+    cycles = 0
+
+    def run_search(self):
+        self.prepare_data()
+
+        route = self.task.get_nearest_neighbour_route()
+        self.best_route = route
+        self.best_cost = self.task.path_cost(route)
+        self.cycles = 0
+
+        if not self.symetric:
+            return self.run_asymetric_search()
+
+        self.set_tour(route)
+        self.cost = self.best_cost
+        self.improve(self.tour)
+        self.update_best()
+
+        # kicks are pointless for tiny tasks
+        if len(self.tour) < 8:
+            return self.get_result()
+
+        for kick in xrange(self.kicks_count):
+            self.cycles += 1
+            touched = self.kick()
+            self.improve(touched)
+
+            if self.cost < self.best_cost - EPSILON:
+                self.update_best()
+            else:
+                # go back to the best tour
+                self.set_tour(list(self.best_route))
+                self.cost = self.best_cost
+
+            self.check_timeout()
+
+        return self.get_result()
+
+    def run_asymetric_search(self):
+        search = LocalSearch(self.task, moves=('2opt', 'oropt'),
+                             check_timeout=self.check_timeout)
+        route = search.improve(self.best_route)
+        self.best_route = route
+        self.best_cost = self.task.path_cost(route)
+
+        for kick in xrange(self.kicks_count):
+            self.cycles += 1
+            route = list(self.best_route)
+            if len(route) < 8:
+                break
+            self.double_bridge(route, 1, len(route) - 1)
+            route = search.improve(route)
+
+            cost = self.task.path_cost(route)
+            if cost < self.best_cost - EPSILON:
+                self.best_route = route
+                self.best_cost = cost
+
+            self.check_timeout()
+
+        return self.get_result()
+
+    def get_result(self):
+        return (self.task.to_names(self.best_route),
+                self.task.path_cost(self.best_route), self.cycles)
+
+    def handle_timeout(self):
+        # current tour might be better than the best one (it was being
+        # improved when time was up)
+        if self.symetric and getattr(self, 'tour', None):
+            route = self.get_route()
+            if self.task.path_cost(route) < self.best_cost:
+                self.best_route = route
+
+        self.best_solution, self.best_distance, self.cycles = (
+                self.get_result())
+
+    # data ------------------------------------------------------------------
+
+    def prepare_data(self):
+        task = self.task
+        matrix = task.matrix
+        self.size = len(matrix)
+
+        # distance function (big tasks calculate distances on demand)
+        if hasattr(matrix, 'distance'):
+            self.dist = matrix.distance
+        else:
+            self.dist = lambda a, b: matrix[a][b]
+
+        self.symetric = task.is_symetric()
+
+        # candidates[a] - nearest nodes of node a
+        self.candidates = task.get_candidates(self.candidates_count)
+
+        # arc that can't be removed (open route is a cycle with it)
+        self.fixed = None
+        if not task.is_circle:
+            self.fixed = (task.finish_idx, task.start_idx)
+
+    # tour ------------------------------------------------------------------
+
+    def set_tour(self, route):
+        # route of a circle ends with start again
+        if self.task.is_circle:
+            route = route[:-1]
+        self.tour = route
+        self.position = position = [0] * self.size
+        for i, node in enumerate(route):
+            position[node] = i
+
+    def get_route(self):
+        # tour as a route from start to finish
+        tour = self.tour
+        n = len(tour)
+        i = self.position[self.task.start_idx]
+
+        step = 1
+        if self.fixed and tour[(i + 1) % n] == self.task.finish_idx:
+            step = -1
+        route = [tour[(i + step * k) % n] for k in xrange(n)]
+
+        if self.task.is_circle:
+            route.append(route[0])
+        return route
+
+    def update_best(self):
+        self.best_cost = self.cost
+        self.best_route = self.get_route()
+
+    def next(self, a):
+        return self.tour[(self.position[a] + 1) % len(self.tour)]
+
+    def prev(self, a):
+        return self.tour[self.position[a] - 1]
+
+    def is_fixed(self, a, b):
+        return self.fixed and (a, b) in (self.fixed, self.fixed[::-1])
+
+    def reverse_path(self, a, b):
+        """
+        Reverse the way from a to b (going forward) - or the rest of the
+        tour, if it is shorter (tour stays the same cycle then).
+        Returns positions of reversed range.
+        """
+        n = len(self.tour)
+        i = self.position[a]
+        j = self.position[b]
+        if ((j - i) % n + 1) * 2 > n:
+            i, j = (j + 1) % n, (i - 1) % n
+        self.reverse_range(i, j)
+        return i, j
+
+    def reverse_range(self, i, j):
+        # reverse tour from position i to j (it may go around the end)
+        tour = self.tour
+        position = self.position
+        n = len(tour)
+        if i <= j:
+            tour[i:j + 1] = tour[j:i - 1 if i else None:-1]
+            positions = xrange(i, j + 1)
+        else:
+            fragment = tour[i:] + tour[:j + 1]
+            fragment.reverse()
+            tour[i:] = fragment[:n - i]
+            tour[:j + 1] = fragment[n - i:]
+            positions = range(i, n) + range(j + 1)
+
+        for k in positions:
+            position[tour[k]] = k
+
+    # Lin-Kernighan step ----------------------------------------------------
+
+    def improve(self, nodes):
+        # nodes which surroundings need to be checked (don't look bits)
+        queue = deque(nodes)
+        queued = set(queue)
+        steps = 0
+        while queue:
+            t1 = queue.popleft()
+            queued.discard(t1)
+
+            touched = self.improve_node(t1)
+            if touched:
+                for node in touched:
+                    if node not in queued:
+                        queue.append(node)
+                        queued.add(node)
+
+            steps += 1
+            if not steps % 100:
+                self.check_timeout()
+
+    def improve_node(self, t1):
+        for t2 in (self.next(t1), self.prev(t1)):
+            if self.is_fixed(t1, t2):
+                continue
+            touched = self.make_chain(t1, t2)
+            if touched:
+                return touched
+
+    def make_chain(self, t1, t2):
+        """
+        Remove arc t1-t2 and make a chain of 2-opt moves. Every move
+        removes arc t3-t4 and adds t2-t3, t4-t1 is the closing arc (it is
+        removed by the next move). Returns nodes which arcs were changed
+        if the tour got shorter.
+        """
+        dist = self.dist
+        gain = dist(t1, t2)  # sum of removed arcs - sum of added arcs
+        best_gain = EPSILON
+        best_length = 0
+        moves = []
+        touched = [t1, t2]
+        added = set()
+        removed = set([(t1, t2), (t2, t1)])
+
+        for depth in xrange(self.max_depth):
+            forward = self.next(t1) == t2
+            neighbours = (self.next(t2), self.prev(t2))
+
+            # choose t3 which gives the largest gain after the move
+            best = None
+            best_value = -INF
+            for t3 in self.candidates[t2]:
+                g1 = gain - dist(t2, t3)
+                if g1 <= 0:
+                    break
+                if t3 == t1 or t3 in neighbours or (t2, t3) in removed:
+                    continue
+
+                t4 = self.prev(t3) if forward else self.next(t3)
+                if (t3, t4) in added or self.is_fixed(t3, t4):
+                    continue
+
+                value = g1 + dist(t3, t4)
+                if value > best_value:
+                    best_value = value
+                    best = t3, t4
+            if not best:
+                break
+
+            t3, t4 = best
+            if forward:
+                moves.append(self.reverse_path(t2, t4))
+            else:
+                moves.append(self.reverse_path(t4, t2))
+            added.update(((t2, t3), (t3, t2)))
+            removed.update(((t3, t4), (t4, t3)))
+            touched.extend((t3, t4))
+
+            gain = best_value
+            closed_gain = gain - dist(t4, t1)
+            if closed_gain > best_gain:
+                best_gain = closed_gain
+                best_length = len(moves)
+
+            t2 = t4
+
+        # roll back moves after the best point of the chain
+        while len(moves) > best_length:
+            self.reverse_range(*moves.pop())
+
+        if best_length:
+            self.cost -= best_gain
+            return touched
+
+    # kicks -----------------------------------------------------------------
+
+    def kick(self):
+        """
+        Double bridge move on the tour (as route from start to finish, so
+        fixed arc stays). Returns nodes which arcs were changed.
+        """
+        route = self.get_route()
+        if self.task.is_circle:
+            route.pop()
+        touched, delta = self.double_bridge(route, 1, len(route) - 1)
+        self.cost += delta
+
+        if self.task.is_circle:
+            route.append(route[0])
+        self.set_tour(route)
+        return touched
+
+    def double_bridge(self, route, first, last):
+        """
+        Swap two neighbouring fragments of route[first:last] (A B C D ->
+        A C B D). Fragments keep their direction, so cost change is just
+        a matter of three arcs. Returns nodes at the ends of changed arcs
+        and the cost change.
+        """
+        dist = self.dist
+        span = self.kick_span
+        p1 = randint(first, last - 3)
+        p2 = randint(p1 + 1, min(p1 + span, last - 2))
+        p3 = randint(p2 + 1, min(p2 + span, last - 1))
+
+        delta = -sum([dist(route[p - 1], route[p]) for p in (p1, p2, p3)])
+        route[p1:p3] = route[p2:p3] + route[p1:p2]
+        delta += sum([dist(route[p - 1], route[p])
+                      for p in (p1, p1 + p3 - p2, p3)])
+
+        touched = set()
+        for p in (p1, p1 + p3 - p2, p3):
+            touched.update((route[p - 1], route[p]))
+        return list(touched), delta
@@ -1,8 +1,8 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
-from copy import deepcopy
-from itertools import permutations
+from heapq import heapify, heappop, heappush
+from itertools import count, izip
 
 from base_solver import BaseSolver
 
@@ -10,302 +10,312 @@ INF = float('inf')
 
 
 class State(object):
+    # Array holds costs between nodes that are still in game only - rows
+    # and cols are indices of those nodes. Rows of array are never changed
+    # in place, so states can share them.
     array = []
-    row_reference = []
-    col_reference = []
+    rows = ()
+    cols = ()
     lower_band = 0
     parent = None
 
-    deleted_arc = None
+    deleted_arc = None  # arc that is included in route by this state
+    depth = 0
+    cell = None  # 0 cell with largest cost of removal (found by reduce)
 
-    is_active = True
+    # fragments of route built so far (first node -> last node and back)
+    tails = {}
+    heads = {}
 
     def __init__(self, **kwargs):
         for key, val in kwargs.items():
             setattr(self, key, val)
 
+    def set_cost(self, i, j, value):
+        # i and j are nodes indices (row is copied - it may be shared)
+        a = self.rows.index(i)
+        b = self.cols.index(j)
+        row = list(self.array[a])
+        row[b] = value
+        self.array[a] = row
+
+    def include_arc(self, i, j):
+        # join fragment ending with i with fragment starting with j
+        self.tails = dict(self.tails)
+        self.heads = dict(self.heads)
+        first = self.heads.pop(i, i)
+        last = self.tails.pop(j, j)
+        self.tails[first] = last
+        self.heads[last] = first
+
+        return first, last
+
 
 class LittleSolver(BaseSolver):
     deterministic = True
 
-    def run_search(self):
-        # prepare initial data
-        reference, cost_array = self.prepare_cost_array()
-        initial_data = {
-            'array': cost_array,
-            'row_reference': reference,
-            'col_reference': deepcopy(reference),
-        }
+    # Memory budget - if there are more open states, solver dives (depth
+    # first) for a complete route and drops all the states that can't
+    # beat it.
+    max_open_states = 200000
+
+    # helpers
+    incumbent = None  # best complete state found by dives
+    peak_open_states = 0
 
+    def run_search(self):
         # set initial state
-        initial = State(**initial_data)
+        initial = State(array=self.prepare_cost_array(),
+                        rows=tuple(range(len(self.task.node_names))),
+                        cols=tuple(range(len(self.task.node_names))))
 
         # check if route should end at the same spot it began...
         if not self.task.is_circle:
             # ... and adjust initial state if it isn't
-            self.non_circle_initial_state(initial)
-
-        states = [initial,]
-        active_states = states
+            initial = self.non_circle_initial_state(initial)
 
-        # start search
-        cycles = 0
-        best_lower_band = INF
+        initial.lower_band += self.reduce(initial)
 
-        while active_states:
-            # rebuild a list of active states
-            active_states = [state for state in states if state.is_active]
-            cycles += 1
+        # states waiting for division, sorted by lower band (deeper states
+        # go first if lower bands are equal)
+        self.order = count()
+        self.heap = []
+        self.push_state(initial)
 
-            # get state with lowest lower band
-            active_states.sort(key=lambda x: x.lower_band)
-            state = active_states[0]
+        self.incumbent = None
+        self.peak_open_states = 1
+        dive_at = self.max_open_states
 
-            # check if it has the anwser
-            if len(state.array) == 2:
-                state.is_active = False
-                break
+        # first route comes from a dive (there is a route to return even
+        # if time is up soon, and it prunes the states from the start)
+        self.cycles = 0
+        if self.heap:
+            self.dive(timed=False)
 
-            # divide it further
-            substates = self.divide_state(state)
+        # start search
+        while self.heap:
+            state = heappop(self.heap)[-1]
+            self.cycles += 1
 
-            if len(substates[0].array) == 2:
-                state = substates[0]
+            # nothing left can beat the best route found by dives
+            if self.incumbent and (
+                    state.lower_band >= self.incumbent.lower_band):
                 break
 
-            # update best found lower band
-            best_lower_band = min(best_lower_band, state.lower_band)
+            # check if it has the anwser
+            if not state.rows:
+                self.incumbent = state
+                break
 
-            # add new states to list
-            states.extend(substates)
+            # divide it further
+            for substate in self.divide_state(state):
+                self.push_state(substate)
 
-            # mark state as inactive
-            state.is_active = False
+            self.peak_open_states = max(self.peak_open_states, len(self.heap))
+            if len(self.heap) > dive_at:
+                self.dive()
+                # if pruning didn't help much, let frontier grow before
+                # the next dive
+                dive_at = max(self.max_open_states, 2 * len(self.heap))
 
             self.check_timeout()
 
-        arcs = self.get_last_arcs_from_final_state(state)
+        solution = self.get_route(self.incumbent)
+        distance = self.task.get_path_distance(solution)
 
+        return solution, distance, self.cycles
+
+    def push_state(self, state):
+        bound = self.incumbent.lower_band if self.incumbent else INF
+        if state.lower_band < bound:
+            heappush(self.heap, (state.lower_band, -state.depth,
+                                 next(self.order), state))
+
+    def dive(self, timed=True):
+        # go depth first from the most promising state, keeping the
+        # other substates for later (timeout isn't checked if not timed)
+        state = heappop(self.heap)[-1]
+        while state.rows:
+            self.cycles += 1
+            state_a, state_b = self.divide_state(state)
+            if state_b.lower_band < state_a.lower_band:
+                state_a, state_b = state_b, state_a
+            self.push_state(state_b)
+
+            state = state_a
+            if state.lower_band == INF:
+                return
+
+            if timed:
+                self.check_timeout()
+
+        # prune states that can't beat the new route
+        if not self.incumbent or (
+                state.lower_band < self.incumbent.lower_band):
+            self.incumbent = state
+            self.heap = [item for item in self.heap
+                         if item[0] < state.lower_band]
+            heapify(self.heap)
+
+    def get_route(self, state):
+        arcs = []
         while state:
             if state.deleted_arc:
                 arcs.append(state.deleted_arc)
             state = state.parent
 
-        solution = self.combine_into_a_route(arcs)
-        distance = self.task.get_path_distance(solution)
-
-        return solution, distance, cycles
+        return self.combine_into_a_route(arcs)
 
-    def divide_state(self, state):
-        # prepare
-        array = deepcopy(state.array)
-
-        row_reference = deepcopy(state.row_reference)
-        col_reference = deepcopy(state.col_reference)
-
-        lower_band_a = state.lower_band
-
-        # standarize array
-        lower_band_a += self.reduce_rows(array)
-        lower_band_a += self.reduce_columns(array)
-
-        lower_band_b = lower_band_a
-
-        # find 0 cell with largest cost of removal
-        lb, cell_cords = self.find_cell_for_removal(array)
-        lower_band_b += lb
-
-        # remove coresponding cells from references
-        # they will be attached to state a as arc to follow
-        node1 = row_reference.pop(cell_cords[0])
-        node2 = col_reference.pop(cell_cords[1])
-
-        # remove cell
-        self.remove_row(cell_cords[0], array)
-        self.remove_column(cell_cords[1], array)
-
-        # block returning path
-        self.block_sub_cycles(array, node1, node2, col_reference,
-                row_reference, state)
-
-        # calculate new lower band for the array with deleted cell
-        lower_band_a += self.reduce_rows(array)
-        lower_band_a += self.reduce_columns(array)
+    def handle_timeout(self):
+        # route found by a dive is still a good anwser
+        if self.incumbent:
+            self.best_solution = self.get_route(self.incumbent)
+            self.best_distance = self.task.get_path_distance(
+                    self.best_solution)
+        else:
+            super(LittleSolver, self).handle_timeout()
 
-        # prepare array for state that rejects found arc
-        state_b_array = deepcopy(state.array)
-        state_b_array[cell_cords[0]][cell_cords[1]] = self.get_big_number(
-                state.array)
+    def get_summary(self):
+        txt = super(LittleSolver, self).get_summary()
+        return txt + 'peak open states: %d\n' % self.peak_open_states
 
-        # generate states
-        state_a = State(array=array, row_reference=row_reference,
-                col_reference=col_reference, lower_band=lower_band_a,
-                parent=state, deleted_arc=(node1, node2))
-        state_b = State(array=state_b_array,
-                row_reference=deepcopy(state.row_reference),
-                col_reference=deepcopy(state.col_reference),
-                lower_band=lower_band_b, parent=state)
+    def divide_state(self, state):
+        # 0 cell with largest cost of removal was found by reduce
+        i, j = state.cell
+        a = state.rows.index(i)
+        b = state.cols.index(j)
+
+        # state a - follows the arc
+        rows = state.rows[:a] + state.rows[a + 1:]
+        cols = state.cols[:b] + state.cols[b + 1:]
+        array_a = [row[:b] + row[b + 1:]
+                   for idx, row in enumerate(state.array) if idx != a]
+        state_a = State(array=array_a, rows=rows, cols=cols,
+                        lower_band=state.lower_band, parent=state,
+                        deleted_arc=(i, j), depth=state.depth + 1,
+                        tails=state.tails, heads=state.heads)
+        first, last = state_a.include_arc(i, j)
+
+        # block returning path (unless it is the last arc to choose)
+        if len(rows) > 1:
+            state_a.set_cost(last, first, INF)
+
+        state_a.lower_band += self.reduce(state_a)
+
+        # state b - rejects the arc
+        state_b = State(array=list(state.array), rows=state.rows,
+                        cols=state.cols, lower_band=state.lower_band,
+                        parent=state.parent, depth=state.depth,
+                        deleted_arc=state.deleted_arc,
+                        tails=state.tails, heads=state.heads)
+        state_b.set_cost(i, j, INF)
+        state_b.lower_band += self.reduce(state_b)
+
+        # divided state isn't needed anymore (only as a parent)
+        state.array = None
 
         return state_a, state_b
 
-    def block_sub_cycles(self, array, node1, node2, col_reference,
-            row_reference, state):
-        # get all included arcs from parent states
-        arcs = []
-        parent = state
-        while parent:
-            if parent.deleted_arc:
-                arcs.append(parent.deleted_arc)
-            parent = parent.parent
-
-        # combine arcs into subroutes
-        def combine_arcs(base_arc, arcs):
-            route = list(base_arc)
-            while arcs:
-                break_out = True
-                for i, arc in enumerate(arcs):
-                    if arc[0] == route[-1]:
-                        route.append(arc[1])
-                        break_out = False
-                        del arcs[i]
-                    elif arc[1] == route[0]:
-                        route.insert(0, arc[0])
-                        break_out = False
-                        del arcs[i]
-
-                if break_out:
-                    break
-
-            return route
-
-        subroutes = []
-        while arcs:
-            arc = arcs.pop()
-            subroutes.append(combine_arcs(arc, arcs))
-
-        # block return path of every subroute
-        for subroute in subroutes:
-            try:
-                start_idx = col_reference.index(subroute[0])
-                end_idx = row_reference.index(subroute[-1])
-                array[end_idx][start_idx] = INF
-            except ValueError:
-                pass
-
-
-    def find_cell_for_removal(self, array):
-        cell_cords = (0, 0)
-        max_cost = 0
-
-        for i, row in enumerate(array):
-            for j, value in enumerate(row):
-                if value == 0:
-                    cost = self.get_min_except_one_0(row)
-                    col = [r[j] for r in array]
-                    cost += self.get_min_except_one_0(col)
-
-                    if cost > max_cost:
-                        max_cost = cost
-                        cell_cords = (i, j)
-
-        return max_cost, cell_cords
-
-    def get_min_except_one_0(self, array):
-        result = INF
-        zero_found = False
-        for v in array:
-            if v != 0:
-                result = min(result, v)
-            elif v == 0 and zero_found:
-                result = 0
-                break
+    def reduce(self, state):
+        """
+        Reduce rows and columns, so there is a 0 in each of them, and find
+        0 cell with largest cost of removal (state.cell) - all in one go
+        over the array.
+        Returns the lower band increase.
+        """
+        cost_array = state.array
+        if not cost_array:
+            return 0
+
+        # reduce rows
+        row_mins = map(min, cost_array)
+        if INF in row_mins:
+            return INF
+        cost_array = [[v - m for v in row] if m else row
+                      for row, m in izip(cost_array, row_mins)]
+
+        # reduce columns
+        columns = zip(*cost_array)
+        col_mins = map(min, columns)
+        if INF in col_mins:
+            return INF
+        if any(col_mins):
+            cost_array = [[v - m for v, m in izip(row, col_mins)]
+                          for row in cost_array]
+            columns = zip(*cost_array)
+
+        state.array = cost_array
+
+        # cost of removal of a 0 cell is a sum of minimums of its row and
+        # column (without the cell itself)
+        row_costs = self.get_removal_costs(cost_array)
+        col_costs = self.get_removal_costs(columns)
+
+        max_cost = -1
+        for a, row in enumerate(cost_array):
+            row_cost = row_costs[a]
+            if row_cost:  # only one 0 in this row
+                zeros = (row.index(0), )
             else:
-                zero_found = True
-        return result
+                zeros = [b for b, v in enumerate(row) if v == 0]
 
-    def get_last_arcs_from_final_state(self, state):
-        # get last two arcs from state with 2x2 array
-        col_idx_1 = state.array[0].index(0)
-        col_idx_2 = state.array[1].index(0)
+            for b in zeros:
+                cost = row_cost + col_costs[b]
+                if cost > max_cost:
+                    max_cost = cost
+                    state.cell = (state.rows[a], state.cols[b])
 
-        arc_1 = state.row_reference[0], state.col_reference[col_idx_1]
-        arc_2 = state.row_reference[1], state.col_reference[col_idx_2]
+        return sum(row_mins) + sum(col_mins)
 
-        return [arc_1, arc_2]
+    def get_removal_costs(self, lines):
+        # minimum of every reduced row (or column) without one of its zeros
+        costs = []
+        for line in lines:
+            idx = line.index(0)
+            costs.append(min(line[:idx] + line[idx + 1:] or [INF]))
+
+        return costs
 
     def combine_into_a_route(self, arcs):
-        route = [self.task.start.name, ]
+        # arcs are pairs of nodes indices
+        following = dict(arcs)
+        route = [self.task.start_idx, ]
 
         while len(route) < len(arcs):
-            for arc in arcs:
-                if arc[0] == route[-1]:
-                    route.append(arc[1])
-                    break
+            route.append(following[route[-1]])
 
-        return route
+        if self.task.is_circle:
+            route.append(self.task.start_idx)
 
-    def get_big_number(self, array):
-        # retutn sum of all positive, non infiniet numbers in array
-        return sum(sum([i for i in row if i > 0 and i < INF]) for row in array) + 1
+        return self.task.to_names(route)
 
     def prepare_cost_array(self):
-        # get nodes names
-        reference = self.task.all_nodes.keys()
-        len_ref = len(reference)
-
-        # prepare array filled with infinity
-        array = [[INF,] * len_ref for i in range(len_ref)]
-
-        # fill array with distances
-        for pair in permutations(range(len_ref), 2):
-            node_a = reference[pair[0]]
-            node_b = reference[pair[1]]
-
-            array[pair[0]][pair[1]] = self.task.get_distance(node_a, node_b)
+        # copy distances, block going from node to itself
+        cost_array = []
+        for i, row in enumerate(self.task.matrix):
+            row = list(row)
+            row[i] = INF
+            cost_array.append(row)
 
-        return reference, array
+        return cost_array
 
     def non_circle_initial_state(self, state):
         """
         Adjust initial state as if arc finish -> start ia already selected
         """
-        start = self.task.start.name
-        end = self.task.finish.name
-        # set states deleted_arc
-        state.deleted_arc = (end, start)
-        # get indexes of start and end nodes
-        start_idx = state.col_reference.index(start)
-        end_idx = state.row_reference.index(end)
-        # delete nodes from references
-        state.col_reference.pop(start_idx)
-        state.row_reference.pop(end_idx)
-        # block start > connection
-        state.array[start_idx][end_idx] = INF
-        # delete column and row from states array
-        self.remove_row(end_idx, state.array)
-        self.remove_column(start_idx, state.array)
-
-    def reduce_rows(self, array):
-        lb = 0
-        for i, row in enumerate(array):
-            m = min(row)
-            lb += m
-            array[i] = [x - m for x in row]
-
-        return lb
-
-    def reduce_columns(self, array):
-        lb = 0
-        for i in range(len(array)):
-            m = min([row[i] for row in array])
-            lb += m
-            for row in array:
-                row[i] -= m
-        return lb
-
-    def remove_column(self, col_idx, array):
-        for row in array:
-            del row[col_idx]
-
-    def remove_row(self, row_idx, array):
-        del array[row_idx]
+        start = self.task.start_idx
+        end = self.task.finish_idx
+
+        state = State(array=[row[:start] + row[start + 1:]
+                             for i, row in enumerate(state.array)
+                             if i != end],
+                      rows=tuple(r for r in state.rows if r != end),
+                      cols=tuple(c for c in state.cols if c != start),
+                      deleted_arc=(end, start))
+        first, last = state.include_arc(end, start)
+
+        # block start > finish connection
+        if len(state.rows) > 1:
+            state.set_cost(last, first, INF)
+
+        return state
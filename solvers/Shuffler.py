@@ -1,8 +1,42 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
+from array import array
+
 from base_solver import BaseSolver
 
+INF = float('inf')
+
+
+class Route(object):
+    """
+    Route kept as a linked list of nodes indices (following[i] is the
+    node visited after i), so inserting a node costs O(1).
+    """
+    def __init__(self, start, finish, size):
+        self.start = start
+        self.finish = finish
+        self.following = array('i', [-1]) * size
+        self.following[start] = finish
+
+    def arcs(self):
+        following = self.following
+        a = self.start
+        while 1:
+            b = following[a]
+            yield a, b
+            if b == self.finish:
+                break
+            a = b
+
+    def insert(self, a, node):
+        # put node right after a
+        self.following[node] = self.following[a]
+        self.following[a] = node
+
+    def to_list(self):
+        return [self.start, ] + [b for a, b in self.arcs()]
+
 
 class ShuffleClosestFirstSolver(BaseSolver):
     deterministic = True
@@ -12,34 +46,39 @@ class ShuffleClosestFirstSolver(BaseSolver):
         for node in self.task.mid_nodes:
             mid_nodes.append(node.name)
 
+        matrix = self.task.matrix
+
         # init solution
-        solution = [self.task.start.name, self.task.finish.name]
+        route = Route(self.task.start_idx, self.task.finish_idx,
+                      len(matrix))
         cycles = 0
         while mid_nodes:
             # get next node to insert into solution
-            node = self.pop_node(solution[-1], mid_nodes)
+            node = self.task.node_index[
+                    self.pop_node(self.task.finish.name, mid_nodes)]
+            row = matrix[node]
 
             # try to put this node in best position on the solution
-            distance = float('inf')
-            idx = 0
-            for i in range(len(solution)-1):
-                s = solution[:i + 1]
-                s.append(node)
-                s += solution[i + 1:]
-
-                d = self.task.get_path_distance(s)
-                if d < distance:
-                    distance = d
-                    idx = i + 1
+            # (cost of putting it between a and b)
+            delta = INF
+            tail = None
+            for a, b in route.arcs():
+                d = matrix[a][node] + row[b] - matrix[a][b]
+                if d < delta:
+                    delta = d
+                    tail = a
 
                 cycles +=1
 
-            # apply node to solution at given index
-            solution.insert(idx, node)
+            # apply node to solution after given node
+            route.insert(tail, node)
 
             self.check_timeout()
 
-        return solution, distance, cycles
+        solution = route.to_list()
+        distance = self.task.path_cost(solution)
+
+        return self.task.to_names(solution), distance, cycles
 
     def pop_node(self, last, mid_nodes):
         return self.task.pop_closest_to(last, mid_nodes)
@@ -48,3 +87,118 @@ class ShuffleClosestFirstSolver(BaseSolver):
 class ShuffleFurtherFirstSolver(ShuffleClosestFirstSolver):
     def pop_node(self, last, mid_nodes):
         return self.task.pop_furthest_to(last, mid_nodes)
+
+
+class CheapestInsertionSolver(BaseSolver):
+    """
+    Inserts the node that is the cheapest to insert. Cheapest position of
+    every node that is not on the route yet is cached - after insertion
+    of a node only the two new arcs are checked, unless the cached
+    position was the arc that got split.
+    """
+    deterministic = True
+
+    def run_search(self):
+        task = self.task
+        matrix = task.matrix
+        size = len(matrix)
+
+        self.route = route = Route(task.start_idx, task.finish_idx, size)
+        self.best_delta = array('d', [INF]) * size
+        self.best_tail = array('i', [-1]) * size
+        self.cycles = 0
+
+        rest = list(task.mid_indices)
+        self.prepare_nodes(rest)
+        for node in rest:
+            self.find_best_position(node)
+
+        while rest:
+            k = self.select_node(rest)
+            node = rest[k]
+            rest[k] = rest[-1]
+            rest.pop()
+
+            a = self.best_tail[node]
+            b = route.following[a]
+            route.insert(a, node)
+            self.node_inserted(node, rest)
+
+            # update cached positions
+            to_node = matrix[node]
+            for x in rest:
+                if self.best_tail[x] == a:
+                    # arc a -> b is gone
+                    self.find_best_position(x)
+                    continue
+
+                row = matrix[x]
+                d = matrix[a][x] + row[node] - matrix[a][node]
+                if d < self.best_delta[x]:
+                    self.best_delta[x] = d
+                    self.best_tail[x] = a
+                d = to_node[x] + row[b] - to_node[b]
+                if d < self.best_delta[x]:
+                    self.best_delta[x] = d
+                    self.best_tail[x] = node
+
+                self.cycles += 2
+
+            self.check_timeout()
+
+        solution = route.to_list()
+        distance = task.path_cost(solution)
+
+        return task.to_names(solution), distance, self.cycles
+
+    def find_best_position(self, node):
+        matrix = self.task.matrix
+        row = matrix[node]
+        delta = INF
+        tail = -1
+        for a, b in self.route.arcs():
+            d = matrix[a][node] + row[b] - matrix[a][b]
+            if d < delta:
+                delta = d
+                tail = a
+            self.cycles += 1
+
+        self.best_delta[node] = delta
+        self.best_tail[node] = tail
+
+    def prepare_nodes(self, rest):
+        pass
+
+    def select_node(self, rest):
+        # position (on rest list) of the node to insert
+        best_delta = self.best_delta
+        return min(xrange(len(rest)), key=lambda k: best_delta[rest[k]])
+
+    def node_inserted(self, node, rest):
+        pass
+
+
+class FarthestInsertionSolver(CheapestInsertionSolver):
+    """
+    Inserts the node that is the farthest from the route (in its cheapest
+    position) - route gets its shape early and is filled in later.
+    """
+    def prepare_nodes(self, rest):
+        # distance from the route to every node
+        matrix = self.task.matrix
+        start = matrix[self.task.start_idx]
+        finish = matrix[self.task.finish_idx]
+        self.far = array('d', [INF]) * len(matrix)
+        for x in rest:
+            self.far[x] = min(start[x], finish[x])
+
+    def select_node(self, rest):
+        far = self.far
+        return max(xrange(len(rest)), key=lambda k: far[rest[k]])
+
+    def node_inserted(self, node, rest):
+        row = self.task.matrix[node]
+        far = self.far
+        for x in rest:
+            if row[x] < far[x]:
+                far[x] = row[x]
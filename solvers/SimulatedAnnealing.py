@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+from datetime import datetime
+from math import exp, log
+from random import choice, randint, random, shuffle
+
+from base_solver import BaseSolver
+
+EPSILON = 1e-9
+
+
+class SimulatedAnnealingSolver(BaseSolver):
+    """
+    Simulated annealing with 2-opt and relocate (Or-opt) moves. A move
+    always makes an arc to one of nearest nodes (candidates), and its cost
+    change is calculated from a few arcs only. Asymmetric tasks need cost of the
+    reversed fragment in 2-opt moves - it is taken from sums of arcs
+    costs along the route (forward and backward), which are recalculated
+    only when the route was changed since the last 2-opt move.
+
+    Temperature goes down geometrically from the one at which half of
+    sampled uphill moves are accepted, to the one at which the small ones
+    are accepted only once in a while. It follows the number of moves, or
+    the time if the task has a timeout that runs out first.
+    """
+    deterministic = False
+
+    candidates_count = 10
+    moves_per_node = 1000  # length of cooling (if time doesn't run out)
+    time_share = 0.9  # part of timeout used for cooling
+    relocate_ratio = 0.5  # part of moves that are relocate moves
+    segment_lengths = (1, 2, 3)  # of relocated fragments
+    calibration_moves = 1000
+    start_acceptance = 0.5  # of median uphill move
+    end_acceptance = 0.01  # of small (5th percentile) uphill move
+
+    # helpers
+    cycles = 0
+
+    def run_search(self):
+        self.prepare_data()
+
+        task = self.task
+        mids = list(task.mid_indices)
+        shuffle(mids)
+        self.set_route([task.start_idx] + mids + [task.finish_idx])
+        self.cost = task.path_cost(self.route)
+        self.best_route = list(self.route)
+        self.best_cost = self.cost
+        self.cycles = 0
+
+        # nothing to anneal
+        if len(mids) < 3:
+            return self.get_result()
+
+        start_temperature, end_temperature = self.calibrate()
+        ratio = end_temperature / start_temperature
+        total_moves = self.moves_per_node * len(mids)
+
+        while 1:
+            if not self.cycles % 100:
+                progress = self.get_progress(total_moves)
+                if progress >= 1:
+                    break
+                temperature = start_temperature * ratio ** progress
+                self.check_timeout()
+
+            self.cycles += 1
+            delta, move = self.draw_move()
+            if not move:
+                continue
+
+            if delta < 0 or random() < exp(-delta / temperature):
+                move(*self.move_args)
+                self.cost += delta
+                if self.cost < self.best_cost - EPSILON:
+                    self.best_cost = self.cost
+                    self.best_route = list(self.route)
+
+        return self.get_result()
+
+    def get_progress(self, total_moves):
+        # part of cooling that is done - of moves or of time, whichever
+        # is used up first
+        progress = float(self.cycles) / total_moves
+        if self.task.timeout:
+            elapsed = (datetime.now() - self.start_time).total_seconds()
+            progress = max(progress,
+                           elapsed / (self.task.timeout * self.time_share))
+        return progress
+
+    def get_result(self):
+        return (self.task.to_names(self.best_route),
+                self.task.path_cost(self.best_route), self.cycles)
+
+    def handle_timeout(self):
+        self.best_solution, self.best_distance, self.cycles = (
+                self.get_result())
+
+    # data --------------------------------------------------------------------
+
+    def prepare_data(self):
+        task = self.task
+        matrix = task.matrix
+
+        # distance function (big tasks calculate distances on demand)
+        if hasattr(matrix, 'distance'):
+            self.dist = matrix.distance
+        else:
+            self.dist = lambda a, b: matrix[a][b]
+
+        self.symetric = task.is_symetric()
+
+        # candidates[a] - nearest nodes to go to from a,
+        # predecessors[a] - nearest nodes to go from to a
+        self.candidates = task.get_candidates(self.candidates_count)
+        self.predecessors = self.candidates
+        if not self.symetric:
+            self.predecessors = task.get_candidates(self.candidates_count,
+                                                    reverse=True)
+
+    def set_route(self, route):
+        self.route = route
+
+        # position of every node on the route (start of a circle is at 0)
+        self.position = position = [0] * len(self.task.matrix)
+        for i, node in enumerate(route):
+            position[node] = i
+        position[route[0]] = 0
+
+        # sums of arcs costs are outdated
+        self.sums_position = 0
+
+    def calibrate(self):
+        """
+        Start and end temperatures from costs of sampled (not made) uphill
+        moves.
+        """
+        uphill = []
+        for k in xrange(self.calibration_moves):
+            delta, move = self.draw_move()
+            if move and delta > EPSILON:
+                uphill.append(delta)
+
+        if not uphill:
+            # nearest neighbours are all at the same distance
+            uphill = [self.cost / len(self.route) or 1.0]
+        uphill.sort()
+
+        median = uphill[len(uphill) // 2]
+        small = uphill[len(uphill) // 20]
+        start = -median / log(self.start_acceptance)
+        end = -small / log(self.end_acceptance)
+        if end >= start:
+            end = start / 1000
+        return start, end
+
+    # moves -------------------------------------------------------------------
+
+    def draw_move(self):
+        """
+        Returns cost change of a random move and the method that makes it
+        (its arguments are kept in move_args), or None if drawn move is not
+        possible.
+        """
+        if random() < self.relocate_ratio:
+            return self.draw_relocate()
+        return self.draw_two_opt()
+
+    def draw_relocate(self):
+        # fragment x..e (keeping its direction) goes right after c
+        route = self.route
+        dist = self.dist
+        last = len(route) - 1
+        i = randint(1, last - 1)
+        length = min(choice(self.segment_lengths), last - i)
+        x = route[i]
+        e = route[i + length - 1]
+        c = choice(self.predecessors[x])
+        j = self.position[c]
+        if j >= last or i - 1 <= j < i + length:
+            return 0, None
+
+        p = route[i - 1]
+        n = route[i + length]
+        following = route[j + 1]
+        delta = (dist(p, n) - dist(p, x) - dist(e, n) +
+                 dist(c, x) + dist(e, following) - dist(c, following))
+
+        self.move_args = (i, length, j)
+        return delta, self.relocate
+
+    def relocate(self, i, length, j):
+        # put route[i:i + length] right after route[j]
+        route = self.route
+        fragment = route[i:i + length]
+        del route[i:i + length]
+        if j > i:
+            j -= length
+        route[j + 1:j + 1] = fragment
+        self.update_positions(min(i, j + 1), max(i, j + 1) + length - 1)
+
+    def draw_two_opt(self):
+        # arcs p -> p + 1 and q -> q + 1 are replaced with p -> q and
+        # p + 1 -> q + 1 (fragment between them is reversed), so a is
+        # connected with its candidate c
+        route = self.route
+        dist = self.dist
+        last = len(route) - 1
+        i = randint(0, last - 1)
+        a = route[i]
+        j = self.position[choice(self.candidates[a])]
+        p, q = min(i, j), max(i, j)
+        if q - p < 2 or q >= last:
+            return 0, None
+
+        a, b = route[p], route[p + 1]
+        c, d = route[q], route[q + 1]
+        delta = dist(a, c) + dist(b, d) - dist(a, b) - dist(c, d)
+        if not self.symetric:
+            delta += self.get_reversal_delta(p + 1, q)
+
+        self.move_args = (p + 1, q)
+        return delta, self.reverse
+
+    def get_reversal_delta(self, i, j):
+        # change of cost of fragment route[i..j] when it gets reversed
+        if self.sums_position is not None:
+            self.update_sums()
+        forward = self.forward
+        backward = self.backward
+        return backward[j] - backward[i] - forward[j] + forward[i]
+
+    def update_sums(self):
+        # sums of arcs costs going forward and backward from the start,
+        # from the first changed position on
+        route = self.route
+        dist = self.dist
+        size = len(route)
+        first = self.sums_position
+        if not first:
+            self.forward = [0] * size
+            self.backward = [0] * size
+
+        forward = self.forward
+        backward = self.backward
+        for k in xrange(max(first, 1), size):
+            a = route[k - 1]
+            b = route[k]
+            forward[k] = forward[k - 1] + dist(a, b)
+            backward[k] = backward[k - 1] + dist(b, a)
+        self.sums_position = None
+
+    def reverse(self, i, j):
+        route = self.route
+        route[i:j + 1] = route[j:i - 1:-1]
+        self.update_positions(i, j)
+
+    def update_positions(self, first, last):
+        # last position (finish) is never updated - it may be start too
+        position = self.position
+        route = self.route
+        for k in xrange(first, min(last + 1, len(route) - 1)):
+            position[route[k]] = k
+
+        # sums of arcs costs are outdated from the first changed position
+        if self.sums_position is None or first < self.sums_position:
+            self.sums_position = first
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+from heapq import heappush, heappushpop
+from math import sqrt
+
+
+class GridIndex(object):
+    """
+    Nodes indices put into square cells of a grid (by their coordinates),
+    so nearest nodes are searched only in cells around a point - ring by
+    ring, until no closer node can be found. The farthest node is searched
+    column by column, from the farthest ones, until no column can have a
+    farther node. Nodes can be removed.
+    """
+    nodes_per_cell = 2
+
+    def __init__(self, xs, ys, indices):
+        # xs and ys are coordinates of all nodes (by index), only given
+        # indices are put into the grid
+        self.xs = xs
+        self.ys = ys
+        self.count = len(indices)
+
+        if not indices:
+            indices = [0]
+        self.min_x = min(xs[i] for i in indices)
+        self.min_y = min(ys[i] for i in indices)
+        width = max(xs[i] for i in indices) - self.min_x
+        height = max(ys[i] for i in indices) - self.min_y
+
+        area = max(width * height, max(width, height) ** 2 / len(indices))
+        self.size = sqrt(area * self.nodes_per_cell / len(indices)) or 1.0
+        self.columns = int(width / self.size) + 1
+        self.rows = int(height / self.size) + 1
+
+        # cells[cy * columns + cx] - list of nodes in cell (cx, cy) or None
+        self.cells = cells = [None] * (self.columns * self.rows)
+        for i in indices:
+            key = self.get_key(xs[i], ys[i])
+            if cells[key] is None:
+                cells[key] = [i]
+            else:
+                cells[key].append(i)
+
+        # nodes in columns and range of rows of their not empty cells, and
+        # range of not empty columns (ranges are narrowed when cells or
+        # columns at their ends get empty)
+        self.column_counts = [0] * self.columns
+        self.low = [self.rows] * self.columns
+        self.high = [-1] * self.columns
+        for key, nodes in enumerate(cells):
+            if nodes:
+                cy, cx = divmod(key, self.columns)
+                self.column_counts[cx] += len(nodes)
+                self.low[cx] = min(self.low[cx], cy)
+                self.high[cx] = max(self.high[cx], cy)
+        self.first_column = 0
+        self.last_column = self.columns - 1
+
+    def get_cell(self, x, y):
+        return (int((x - self.min_x) / self.size),
+                int((y - self.min_y) / self.size))
+
+    def get_key(self, x, y):
+        cx, cy = self.get_cell(x, y)
+        return cy * self.columns + cx
+
+    def remove(self, i, key=None):
+        if key is None:
+            key = self.get_key(self.xs[i], self.ys[i])
+        nodes = self.cells[key]
+        nodes.remove(i)
+        if not nodes:
+            self.cells[key] = None
+        self.column_counts[key % self.columns] -= 1
+        self.count -= 1
+
+    def get_ring(self, cx, cy, r):
+        # keys of cells of the grid that are r cells away from cell (cx, cy)
+        columns = self.columns
+        rows = self.rows
+        first = max(cx - r, 0)
+        last = min(cx + r, columns - 1)
+
+        keys = []
+        for y in ((cy - r, cy + r) if r else (cy, )):
+            if 0 <= y < rows:
+                keys.extend(xrange(y * columns + first, y * columns + last + 1))
+        for x in ((cx - r, cx + r) if r else ()):
+            if 0 <= x < columns:
+                keys.extend(xrange(max(cy - r + 1, 0) * columns + x,
+                                   min(cy + r, rows) * columns, columns))
+        return keys
+
+    def nearest(self, x, y, k=1):
+        """
+        Returns list of up to k (distance, index) pairs of nodes nearest
+        to the point, sorted by distance.
+        """
+        xs = self.xs
+        ys = self.ys
+        cells = self.cells
+        cx, cy = self.get_cell(x, y)
+        k = min(k, self.count)
+        if not k:
+            return []
+
+        # rings that need to be checked to cover the whole grid
+        last_ring = max(abs(cx), abs(self.columns - 1 - cx),
+                        abs(cy), abs(self.rows - 1 - cy))
+
+        found = []  # heap of (-squared distance, index)
+        r = 0
+        while r <= last_ring:
+            for key in self.get_ring(cx, cy, r):
+                nodes = cells[key]
+                if not nodes:
+                    continue
+                for i in nodes:
+                    d = (x - xs[i]) ** 2 + (y - ys[i]) ** 2
+                    if len(found) < k:
+                        heappush(found, (-d, i))
+                    elif d < -found[0][0]:
+                        heappushpop(found, (-d, i))
+
+            # nodes in further rings are at least r cells away
+            if len(found) == k and -found[0][0] <= (r * self.size) ** 2:
+                break
+            r += 1
+
+        return sorted((sqrt(-d), i) for d, i in found)
+
+    def pop_nearest(self, x, y):
+        """
+        Removes the node nearest to the point and returns its index (or
+        None if the grid is empty) - nearest(x, y) made lean, as it is used
+        to build whole routes.
+        """
+        if not self.count:
+            return None
+
+        xs = self.xs
+        ys = self.ys
+        cells = self.cells
+
+        # point in cells units
+        fx = (x - self.min_x) / self.size
+        fy = (y - self.min_y) / self.size
+        cx = int(fx)
+        cy = int(fy)
+        last_ring = max(abs(cx), abs(self.columns - 1 - cx),
+                        abs(cy), abs(self.rows - 1 - cy))
+
+        best = float('inf')
+        found = found_key = None
+
+        # the cell and its neighbours are checked at once
+        keys = self.get_ring(cx, cy, 0) + self.get_ring(cx, cy, 1)
+        r = 1
+        while 1:
+            for key in keys:
+                nodes = cells[key]
+                if nodes:
+                    for i in nodes:
+                        dx = x - xs[i]
+                        dy = y - ys[i]
+                        d = dx * dx + dy * dy
+                        if d < best:
+                            best = d
+                            found = i
+                            found_key = key
+
+            # nodes in further rings are farther than edges of this one
+            edge = min(fx - cx + r, cx + r + 1 - fx,
+                       fy - cy + r, cy + r + 1 - fy) * self.size
+            if best <= edge * edge:
+                break
+            r += 1
+            if r > last_ring:
+                break
+            keys = self.get_ring(cx, cy, r)
+
+        self.remove(found, found_key)
+        return found
+
+    def pop_farthest(self, x, y):
+        # removes the node farthest from the point and returns its index
+        # (or None if the grid is empty)
+        found = self.farthest(x, y)
+        if found is None:
+            return None
+        self.remove(found[1])
+        return found[1]
+
+    def farthest(self, x, y):
+        """
+        Returns (distance, index) pair of node farthest from the point, or
+        None if the grid is empty.
+        """
+        if not self.count:
+            return None
+
+        xs = self.xs
+        ys = self.ys
+        cells = self.cells
+        columns = self.columns
+        size = self.size
+        counts = self.column_counts
+        low = self.low
+        high = self.high
+
+        # point relative to the grid (in cells, shifted to cells centers)
+        # - max distance to a cell is (|center - point| + 0.5) * size
+        px = (x - self.min_x) / size - 0.5
+        py = (y - self.min_y) / size - 0.5
+
+        # square of the max vertical distance to any cell
+        max_dy = (max(abs(py), abs(self.rows - 1 - py)) + 0.5) * size
+        max_dy *= max_dy
+
+        # narrow the range of not empty columns
+        while not counts[self.first_column]:
+            self.first_column += 1
+        while not counts[self.last_column]:
+            self.last_column -= 1
+
+        # columns are checked from both sides of the grid, the farther
+        # one first (until they meet)
+        best = -1
+        found = None
+        left = self.first_column
+        right = self.last_column
+        while left <= right:
+            dx_left = (abs(px - left) + 0.5) * size
+            dx_right = (abs(px - right) + 0.5) * size
+            if dx_left >= dx_right:
+                cx = left
+                dx = dx_left
+                left += 1
+            else:
+                cx = right
+                dx = dx_right
+                right -= 1
+
+            dx *= dx
+            if dx + max_dy < best:
+                break
+            if not counts[cx]:
+                continue
+
+            # narrow the range of not empty cells of the column
+            while not cells[low[cx] * columns + cx]:
+                low[cx] += 1
+            while not cells[high[cx] * columns + cx]:
+                high[cx] -= 1
+
+            # cells of the column are checked from both ends, the farther
+            # one first (until they meet)
+            bottom = low[cx]
+            top = high[cx]
+            dy = (max(abs(py - bottom), abs(py - top)) + 0.5) * size
+            if dx + dy * dy < best:
+                continue
+            while bottom <= top:
+                dy_bottom = (abs(py - bottom) + 0.5) * size
+                dy_top = (abs(py - top) + 0.5) * size
+                if dy_bottom >= dy_top:
+                    cy = bottom
+                    dy = dy_bottom
+                    bottom += 1
+                else:
+                    cy = top
+                    dy = dy_top
+                    top -= 1
+
+                if dx + dy * dy < best:
+                    break
+                nodes = cells[cy * columns + cx]
+                if not nodes:
+                    continue
+                for i in nodes:
+                    d = (x - xs[i]) ** 2 + (y - ys[i]) ** 2
+                    if d > best:
+                        best = d
+                        found = i
+
+        return sqrt(best), found